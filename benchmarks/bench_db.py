@@ -0,0 +1,61 @@
+"""register/unregister, add_cancel/remove_cancel and batched registration throughput on the SQLite database."""
+import pytest
+
+from octoprint_wyze.events import ActionType, EventHandler, EventType
+
+
+@pytest.fixture
+def event_handler(data_folder):
+    event_handler = EventHandler(data_folder)
+    yield event_handler
+    event_handler.close()
+
+
+@pytest.mark.parametrize("synchronous", ["NORMAL", "FULL"])
+def test_register_unregister(benchmark, data_folder, synchronous):
+    event_handler = EventHandler(data_folder, synchronous=synchronous)
+
+    def register_unregister():
+        event_handler.register("AA:BB:CC:DD:EE:FF", EventType.PRINT_DONE, ActionType.TURN_OFF, 15)
+        event_handler.unregister("AA:BB:CC:DD:EE:FF", EventType.PRINT_DONE, ActionType.TURN_OFF)
+
+    benchmark(register_unregister)
+    event_handler.close()
+
+
+def test_add_remove_cancel(benchmark, event_handler):
+    def add_remove_cancel():
+        event_handler.add_cancel("AA:BB:CC:DD:EE:FF", EventType.PRINT_STARTED, ActionType.TURN_OFF)
+        event_handler.remove_cancel("AA:BB:CC:DD:EE:FF", EventType.PRINT_STARTED, ActionType.TURN_OFF)
+
+    benchmark(add_remove_cancel)
+
+
+def _full_setup(operation):
+    # 10 devices x every event x both actions, as when setting up a new printer
+    return [
+        (operation, f"AA:BB:CC:DD:EE:{i:02X}", event, action, 15)
+        for i in range(10)
+        for event in EventType.discrete()
+        for action in ActionType
+    ]
+
+
+def test_register_one_by_one(benchmark, event_handler):
+    changes = _full_setup(EventHandler.REGISTER)
+
+    def register_all():
+        for _, device_mac, event, action, delay in changes:
+            event_handler.register(device_mac, event, action, delay)
+
+    benchmark.pedantic(register_all, setup=lambda: event_handler.apply_registrations(_full_setup(EventHandler.UNREGISTER)), rounds=20)
+
+
+def test_apply_registrations(benchmark, event_handler):
+    changes = _full_setup(EventHandler.REGISTER)
+    benchmark.pedantic(
+        event_handler.apply_registrations,
+        args=(changes, ),
+        setup=lambda: event_handler.apply_registrations(_full_setup(EventHandler.UNREGISTER)),
+        rounds=20,
+    )
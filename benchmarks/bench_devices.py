@@ -0,0 +1,55 @@
+"""Device list and registration throughput."""
+import flask
+import pytest
+
+
+@pytest.mark.parametrize("device_count", [10, 100, 500])
+def test_get_devices(benchmark, make_plugin, register_devices, device_count):
+    plugin = make_plugin(device_count=device_count)
+    register_devices(plugin.event_handler, list(plugin.wyze.devices), 0.2)
+    benchmark(plugin.wyze.get_devices, plugin.event_handler)
+
+
+@pytest.mark.parametrize("device_count", [10, 100, 500])
+@pytest.mark.parametrize("revalidated", [False, True], ids=["full", "not_modified"])
+def test_get_devices_api(benchmark, make_plugin, register_devices, device_count, revalidated):
+    """The get_devices API command, serialized, without and with a current If-None-Match."""
+    plugin = make_plugin(device_count=device_count)
+    register_devices(plugin.event_handler, list(plugin.wyze.devices), 0.2)
+    headers = {"If-None-Match": f'"{plugin.devices_etag(plugin.wyze)}"'} if revalidated else {}
+    app = flask.Flask(__name__)
+
+    def get_devices():
+        with app.test_request_context(method="POST", headers=headers):
+            return plugin.on_api_command("get_devices", {})
+
+    response = benchmark(get_devices)
+    assert response.status_code == (304 if revalidated else 200)
+
+
+@pytest.mark.parametrize("device_count", [10, 100, 500])
+def test_get_registrations(benchmark, make_plugin, register_devices, device_count):
+    plugin = make_plugin(device_count=device_count)
+    device_macs = list(plugin.wyze.devices)
+    register_devices(plugin.event_handler, device_macs, 0.2)
+
+    def get_registrations():
+        for device_mac in device_macs:
+            plugin.event_handler.get_registrations(device_mac)
+
+    benchmark(get_registrations)
+
+
+@pytest.mark.parametrize("device_count", [10, 100, 500])
+def test_get_all_registrations(benchmark, make_plugin, register_devices, device_count):
+    plugin = make_plugin(device_count=device_count)
+    register_devices(plugin.event_handler, list(plugin.wyze.devices), 0.2)
+    benchmark(plugin.event_handler.get_all_registrations)
+
+
+@pytest.mark.parametrize("latency,error_rate", [(0, 0), (0.005, 0), (0.005, 0.2)])
+def test_refresh_devices(benchmark, make_plugin, latency, error_rate):
+    # Open the rate limiter so only the client latency and retries are measured
+    plugin = make_plugin(device_count=50, latency=latency, error_rate=error_rate, api_rate=1e6, api_burst=1e6)
+    plugin.api.base_delay = 0.001
+    benchmark.pedantic(plugin.wyze.refresh_devices, rounds=30)
@@ -0,0 +1,104 @@
+"""
+Per-operation latency of the EventHandler database, before and after the
+switch to a persistent WAL-mode connection.
+
+"before" replays the old behaviour of opening, committing and closing a new
+connection on every call. Run from the repository root:
+
+    python benchmarks/bench_event_handler_db.py [--iterations N] [--dir PATH]
+
+Point --dir at the storage you care about (e.g. the SD card on a Pi), since
+the difference is dominated by fsyncs.
+"""
+import argparse
+import sqlite3
+import tempfile
+import time
+
+from contextlib import contextmanager
+
+from octoprint_wyze.events import ActionType, EventHandler, EventType
+
+
+class ConnectPerCallDatabase:
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+    @contextmanager
+    def _conn(self):
+        conn = sqlite3.connect(self.db_path)
+        cur = conn.cursor()
+        yield cur
+        conn.commit()
+        conn.close()
+
+    read = _conn
+    write = _conn
+
+    def close(self):
+        pass
+
+
+def time_operation(function, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        function(i)
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def run(event_handler, iterations):
+    device_macs = [f"AA:BB:CC:DD:EE:{i:02X}" for i in range(16)]
+
+    def register(i):
+        event_handler.register(device_macs[i % 16], EventType(i % len(EventType.discrete())), ActionType.TURN_ON, 0)
+
+    def unregister(i):
+        event_handler.unregister(device_macs[i % 16], EventType(i % len(EventType.discrete())), ActionType.TURN_ON)
+
+    def add_cancel(i):
+        event_handler.add_cancel(device_macs[i % 16], EventType(i % len(EventType.discrete())), ActionType.TURN_OFF)
+
+    def remove_cancel(i):
+        event_handler.remove_cancel(device_macs[i % 16], EventType(i % len(EventType.discrete())), ActionType.TURN_OFF)
+
+    def get_registrations(i):
+        event_handler.get_registrations(device_macs[i % 16])
+
+    results = {}
+    for name, function in (
+        ("register", register),
+        ("unregister", unregister),
+        ("add_cancel", add_cancel),
+        ("remove_cancel", remove_cancel),
+        ("get_registrations", get_registrations),
+    ):
+        results[name] = time_operation(function, iterations)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--dir", default=None)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as before_dir, tempfile.TemporaryDirectory(dir=args.dir) as after_dir:
+        before = EventHandler(before_dir)
+        before.db.close()
+        # WAL mode is persistent, so put the old database back into rollback journal mode
+        with ConnectPerCallDatabase(before.db_path).write() as cur:
+            cur.execute("PRAGMA journal_mode=DELETE").fetchall()
+        before.db = ConnectPerCallDatabase(before.db_path)
+        after = EventHandler(after_dir)
+        before_results = run(before, args.iterations)
+        after_results = run(after, args.iterations)
+        after.close()
+
+    print(f"{'operation':<20}{'before (us)':>14}{'after (us)':>14}{'speedup':>10}")
+    for name in before_results:
+        speedup = before_results[name] / after_results[name]
+        print(f"{name:<20}{before_results[name]:>14.1f}{after_results[name]:>14.1f}{speedup:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
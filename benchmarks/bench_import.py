@@ -0,0 +1,39 @@
+"""Import time of the plugin package, measured with ``python -X importtime`` in a fresh interpreter."""
+import subprocess
+import sys
+
+# Modules that must only be loaded once they are actually needed
+LAZY_MODULES = ("wyze_sdk", "cryptography.fernet")
+
+# flask and octoprint.plugin are already loaded by OctoPrint before any plugin,
+# so they are imported first to keep them out of the plugin's own figure
+SCRIPT = """
+import sys
+import flask, octoprint.plugin
+import octoprint_wyze
+print(",".join(name for name in {lazy!r} if name in sys.modules))
+"""
+
+
+def import_plugin():
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", SCRIPT.format(lazy=LAZY_MODULES)],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    cumulative = None
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip() == "octoprint_wyze":
+            cumulative = int(fields[1])
+    loaded = [name for name in result.stdout.strip().split(",") if name]
+    return cumulative, loaded
+
+
+def test_import_plugin(benchmark):
+    cumulative, loaded = benchmark.pedantic(import_plugin, rounds=5, iterations=1)
+    assert cumulative is not None
+    assert loaded == []
+    benchmark.extra_info["cumulative_us"] = cumulative
@@ -0,0 +1,50 @@
+"""WyzePlugin event handling latency against device count and registration density."""
+import time
+
+import pytest
+
+from octoprint_wyze.events import EventType
+
+
+def _clear_pending_actions(plugin):
+    for action in plugin.scheduler.pending_actions():
+        plugin.scheduler.cancel(action)
+
+
+@pytest.mark.parametrize("density", [0.1, 0.5])
+@pytest.mark.parametrize("device_count", [10, 50, 200])
+def test_handle_event(benchmark, make_plugin, register_devices, device_count, density):
+    plugin = make_plugin(device_count=device_count)
+    register_devices(plugin.event_handler, list(plugin.wyze.devices), density)
+    benchmark.pedantic(
+        plugin.handle_event,
+        args=(EventType.PRINT_DONE, "PrintDone"),
+        setup=lambda: _clear_pending_actions(plugin),
+        rounds=200,
+    )
+
+
+@pytest.mark.parametrize("device_count", [10, 200])
+def test_on_event_subscribed(benchmark, make_plugin, register_devices, device_count):
+    plugin = make_plugin(device_count=device_count)
+    register_devices(plugin.event_handler, list(plugin.wyze.devices), 0.5)
+
+    def wait_for_queue():
+        # Time only the hand-off to the event queue, not the consumer catching up
+        while plugin.event_queue.depth():
+            time.sleep(0.001)
+        _clear_pending_actions(plugin)
+
+    benchmark.pedantic(
+        plugin.on_event,
+        args=("PrintDone", {}),
+        setup=wait_for_queue,
+        rounds=200,
+    )
+
+
+@pytest.mark.parametrize("device_count", [10, 200])
+def test_on_event_unsubscribed(benchmark, make_plugin, register_devices, device_count):
+    plugin = make_plugin(device_count=device_count)
+    register_devices(plugin.event_handler, list(plugin.wyze.devices), 0.5)
+    benchmark(plugin.on_event, "ZChange", {"new": 0.2, "old": 0})
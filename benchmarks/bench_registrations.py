@@ -0,0 +1,70 @@
+"""
+Registration loading for the device list as the device count grows: one
+get_registrations call per device versus a single get_all_registrations.
+Run from the repository root:
+
+    python benchmarks/bench_registrations.py [--devices 10 50 100 250 500] [--density 0.2]
+
+--density is the fraction of (event, action) pairs each device is
+registered for, with the same fraction set up as cancellations.
+"""
+import argparse
+import random
+import tempfile
+import time
+
+from octoprint_wyze.events import ActionType, EventHandler, EventType
+
+
+def populate(event_handler, device_macs, density, seed=0):
+    rng = random.Random(seed)
+    for device_mac in device_macs:
+        for event in EventType.discrete():
+            for action in ActionType:
+                if rng.random() < density:
+                    event_handler.register(device_mac, event, action, rng.choice((0, 0.5, 15)))
+                if rng.random() < density:
+                    event_handler.add_cancel(device_mac, event, action)
+
+
+def best_of(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--devices", type=int, nargs="+", default=[10, 50, 100, 250, 500])
+    parser.add_argument("--density", type=float, default=0.2)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'devices':>8}{'per device (ms)':>18}{'bulk (ms)':>12}{'speedup':>10}")
+    for device_count in args.devices:
+        with tempfile.TemporaryDirectory() as data_folder:
+            event_handler = EventHandler(data_folder)
+            device_macs = [f"AA:BB:CC:{i // 65536:02X}:{i // 256 % 256:02X}:{i % 256:02X}" for i in range(device_count)]
+            populate(event_handler, device_macs, args.density)
+
+            def per_device():
+                return {device_mac: event_handler.get_registrations(device_mac) for device_mac in device_macs}
+
+            def bulk():
+                registrations = event_handler.get_all_registrations()
+                empty = (event_handler.empty_registrations(), event_handler.empty_registrations())
+                return {device_mac: registrations.get(device_mac, empty) for device_mac in device_macs}
+
+            assert per_device() == bulk()
+
+            before = best_of(per_device, args.repeat)
+            after = best_of(bulk, args.repeat)
+            event_handler.close()
+        print(f"{device_count:>8}{before:>18.2f}{after:>12.2f}{before / after:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""Action scheduling overhead with K actions already pending."""
+import logging
+
+import pytest
+
+from octoprint_wyze.events import Action, ActionScheduler, ActionType, EventType
+
+
+class Device:
+    def __init__(self, mac):
+        self.mac = mac
+
+    def __str__(self):
+        return self.mac
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = ActionScheduler(logging.getLogger("octoprint.plugins.wyze.benchmarks"))
+    scheduler.start()
+    yield scheduler
+    scheduler.stop()
+
+
+def fill(scheduler, pending_count):
+    for i in range(pending_count):
+        # Far enough out that nothing fires during the benchmark
+        scheduler.schedule(Action(ActionType.TURN_OFF, EventType.PRINT_DONE, Device(f"device-{i}"), delay=60 + i))
+
+
+@pytest.mark.parametrize("pending_count", [0, 100, 1000, 10000])
+def test_schedule_and_cancel(benchmark, scheduler, pending_count):
+    fill(scheduler, pending_count)
+    device = Device("benchmark")
+
+    def schedule_and_cancel():
+        action = Action(ActionType.TURN_ON, EventType.PRINT_STARTED, device, delay=30)
+        scheduler.schedule(action)
+        scheduler.cancel(action)
+
+    benchmark(schedule_and_cancel)
+
+
+@pytest.mark.parametrize("pending_count", [10, 100, 1000])
+def test_pending_actions_snapshot(benchmark, scheduler, pending_count):
+    fill(scheduler, pending_count)
+    benchmark(scheduler.pending_actions)
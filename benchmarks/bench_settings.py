@@ -0,0 +1,38 @@
+"""on_settings_load and on_settings_save with stored Wyze credentials, cached and cold."""
+import pytest
+
+from octoprint_wyze.wyze_devices import CredentialStore
+
+
+CREDENTIALS = {
+    "wyze_email": "bench@example.com",
+    "wyze_password": "password",
+    "wyze_api_key": "api-key",
+    "wyze_key_id": "key-id",
+}
+
+
+@pytest.fixture
+def plugin(make_plugin):
+    plugin = make_plugin()
+    plugin.on_settings_save(dict(CREDENTIALS))
+    return plugin
+
+
+@pytest.mark.parametrize("cached", [True, False], ids=["cached", "cold"])
+def test_settings_load(benchmark, plugin, cached):
+    def load():
+        if not cached:
+            # What every load cost before the credentials were kept in memory
+            plugin.credentials = CredentialStore()
+        return plugin.on_settings_load()
+
+    data = benchmark(load)
+    assert data["wyze_password"] == CREDENTIALS["wyze_password"]
+
+
+def test_settings_save_unchanged(benchmark, plugin):
+    key = plugin._settings.get(["wyze_key"])
+    benchmark(lambda: plugin.on_settings_save(dict(CREDENTIALS)))
+    assert plugin._settings.get(["wyze_key"]) == key
+    assert plugin.credentials.stats["encrypts"] == 1
@@ -0,0 +1,167 @@
+import logging
+import random
+import tempfile
+import time
+
+from types import SimpleNamespace
+
+import pytest
+
+from wyze_sdk.errors import WyzeApiError
+
+import octoprint_wyze.wyze_devices
+from octoprint_wyze import WyzePlugin
+from octoprint_wyze.events import ActionType, EventType
+
+
+class FakeWyzeClient:
+    """
+    Stands in for wyze_sdk.Client with N plugs, a fixed latency per call and
+    a share of calls that fail, half as connection errors (retried) and half
+    as API errors (not retried).
+    """
+
+    def __init__(self, device_count=10, latency=0, error_rate=0, seed=0, **kwargs):
+        self.latency = latency
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._token = "access-token"
+        self._refresh_token = "refresh-token"
+        self.plugs = self.bulbs = self.cameras = self
+        self.calls = 0
+        self.devices = [
+            SimpleNamespace(
+                mac=f"AA:BB:CC:{i // 65536:02X}:{i // 256 % 256:02X}:{i % 256:02X}",
+                nickname=f"Plug {i}",
+                type="Plug",
+                product=SimpleNamespace(model="WLPP1CFH"),
+                is_on=False,
+                is_online=True,
+            )
+            for i in range(device_count)
+        ]
+
+    def _call(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self._random.random() < self.error_rate:
+            if self._random.random() < 0.5:
+                raise ConnectionError("Simulated connection error.")
+            raise WyzeApiError("Simulated API error.", {"code": 1003})
+
+    def devices_list(self):
+        self._call()
+        return [SimpleNamespace(**vars(device)) for device in self.devices]
+
+    def turn_on(self, device_mac, device_model):
+        self._call()
+
+    def turn_off(self, device_mac, device_model):
+        self._call()
+
+    def refresh_token(self):
+        self._call()
+
+
+class FakeSettings:
+    def __init__(self, defaults):
+        self.data = dict(defaults)
+
+    def get(self, path, **kwargs):
+        return self.data.get(path[0])
+
+    def get_int(self, path, **kwargs):
+        return int(self.data.get(path[0]))
+
+    def get_float(self, path, **kwargs):
+        return float(self.data.get(path[0]))
+
+    def get_boolean(self, path, **kwargs):
+        return bool(self.data.get(path[0]))
+
+    def set(self, path, value, **kwargs):
+        if path:
+            self.data[path[0]] = value
+        else:
+            self.data.update(value)
+
+    def get_all_data(self, **kwargs):
+        return dict(self.data)
+
+
+class FakePluginManager:
+    def send_plugin_message(self, identifier, message):
+        pass
+
+
+class FakePrinter:
+    def is_printing(self):
+        return False
+
+    def is_paused(self):
+        return False
+
+
+@pytest.fixture
+def fake_client(monkeypatch):
+    """Returns a factory that makes the next Wyze login produce a FakeWyzeClient."""
+    def factory(**options):
+        client = FakeWyzeClient(**options)
+        monkeypatch.setattr(octoprint_wyze.wyze_devices, "create_client", lambda **kwargs: client)
+        return client
+    return factory
+
+
+@pytest.fixture
+def data_folder():
+    with tempfile.TemporaryDirectory() as folder:
+        yield folder
+
+
+@pytest.fixture
+def make_plugin(fake_client, data_folder):
+    """Returns a factory for a started, connected WyzePlugin backed by a FakeWyzeClient."""
+    plugins = []
+
+    def factory(device_count=10, latency=0, error_rate=0, **settings):
+        client = fake_client(device_count=device_count, latency=latency, error_rate=error_rate)
+        plugin = WyzePlugin()
+        plugin._identifier = "wyze"
+        plugin._logger = logging.getLogger("octoprint.plugins.wyze.benchmarks")
+        plugin._settings = FakeSettings(plugin.get_settings_defaults())
+        plugin._settings.data.update(settings)
+        plugin._plugin_manager = FakePluginManager()
+        plugin._printer = FakePrinter()
+        plugin.get_plugin_data_folder = lambda: data_folder
+        plugin.on_startup("127.0.0.1", 5000)
+        plugin.on_after_startup()
+        plugin.connection.connect("bench@example.com", "password", "api-key", "key-id")
+        deadline = time.monotonic() + 10
+        while plugin.wyze is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert plugin.wyze is not None, plugin.connection.status()
+        plugin.client = client
+        plugins.append(plugin)
+        return plugin
+
+    yield factory
+    for plugin in plugins:
+        plugin.on_shutdown()
+
+
+@pytest.fixture
+def register_devices():
+    """Returns a helper that registers each device for roughly `density` of the (event, action) pairs, with as many cancellations."""
+    return _register_devices
+
+
+def _register_devices(event_handler, device_macs, density, seed=0):
+    rng = random.Random(seed)
+    for device_mac in device_macs:
+        for event in EventType.discrete():
+            for action in ActionType:
+                if rng.random() < density:
+                    event_handler.register(device_mac, event, action, rng.choice((0.5, 15, 45)))
+                if rng.random() < density:
+                    event_handler.add_cancel(device_mac, event, action)
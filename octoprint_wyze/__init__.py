@@ -1,40 +1,301 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
 
+import hashlib
+import json
+import os
+import time
+
+from threading import Lock
+
 import flask
 
-from cryptography.fernet import Fernet
 from octoprint.plugin import (
     AssetPlugin,
+    BlueprintPlugin,
     EventHandlerPlugin,
+    ProgressPlugin,
     SettingsPlugin,
+    ShutdownPlugin,
     SimpleApiPlugin,
     StartupPlugin,
     TemplatePlugin, 
 )
+from .api import ApiClient
 from .events import (
+    Action,
+    ActionJournal,
+    ActionScheduler,
     ActionType,
+    Database,
     EventHandler,
+    EventQueue,
     EventType,
+    parse_progress_rule,
+    parse_temperature_rule,
 )
-from .wyze_devices import Wyze
+from .metrics import metrics
+from .triggers import ProgressMonitor, ProgressRule, TemperatureMonitor, TemperatureRule
+from .wyze_devices import CommandDispatcher, CredentialStore, DeviceHealth, Job, TokenStore, WyzeConnection
         
 
 class WyzePlugin(
     AssetPlugin,
+    BlueprintPlugin,
     EventHandlerPlugin,
+    ProgressPlugin,
     SettingsPlugin,
+    ShutdownPlugin,
     SimpleApiPlugin,
     StartupPlugin,
     TemplatePlugin,
 ):
     def on_startup(self, host, port):
-        self.pending_actions = []
+        self.api = ApiClient(
+            rate=self._settings.get_float(["api_rate"]),
+            burst=self._settings.get_float(["api_burst"]),
+            timeout=self._settings.get_float(["api_timeout"]),
+            socket_timeout=self._settings.get_float(["api_socket_timeout"]),
+            max_attempts=self._settings.get_int(["api_max_attempts"]),
+            failure_threshold=self._settings.get_int(["api_failure_threshold"]),
+            reset_timeout=self._settings.get_float(["api_reset_timeout"]),
+            logger=self._logger,
+        )
+        self.health = DeviceHealth(
+            self.api,
+            probe_interval=self._settings.get_float(["device_health_probe_interval"]),
+            refresh=self.probe_devices,
+            on_change=self.on_device_health_change,
+            on_probe=self.expire_deferred_jobs,
+            logger=self._logger,
+        )
+        self.dispatcher = CommandDispatcher(
+            max_workers=self._settings.get_int(["max_command_workers"]),
+            coalesce_window=self._settings.get_float(["command_coalesce_window"]),
+            state_ttl=self._settings.get_float(["device_state_ttl"]),
+            on_complete=self.on_job_complete,
+            health=self.health,
+            defer_offline=self._settings.get_boolean(["defer_offline_commands"]),
+            defer_timeout=self._settings.get_float(["offline_command_timeout"]),
+            resolve=self.resolve_device,
+            renew=self.renew_session,
+            logger=self._logger,
+        )
+        # Started once the dispatcher exists, since every probe expires its deferred jobs
+        self.health.start()
+        self.scheduler = ActionScheduler(
+            self._logger,
+            on_change=self.on_pending_action_change,
+            dispatcher=self.dispatcher,
+        )
+        self.scheduler.start()
+        metrics.gauge("pending_actions", lambda: len(self.scheduler.registry))
+        for name in self.dispatcher.get_stats():
+            metrics.gauge(f"commands_{name}", lambda name=name: self.dispatcher.get_stats()[name])
+        self.event_queue = EventQueue(
+            self.handle_event,
+            self._logger,
+            maxsize=self._settings.get_int(["event_queue_size"]),
+        )
+        self.event_queue.start()
+        metrics.gauge("event_queue_depth", self.event_queue.depth)
+        for name in self.event_queue.stats:
+            metrics.gauge(f"events_{name}", lambda name=name: self.event_queue.stats[name])
+        self.temperature_monitor = TemperatureMonitor(on_trigger=self.on_trigger)
+        self.progress_monitor = ProgressMonitor(on_trigger=self.on_trigger)
+        self.recovered_actions = []
+        self._recovery_lock = Lock()
+        self._recovery_attempted = False
+        # Device ETags carry this so a cached payload never survives a restart
+        self.boot_id = os.urandom(4).hex()
+        self.enums = {
+            "events": [EventType.get_name(event) for event in EventType.discrete()],
+            "actions": [ActionType.get_name(action) for action in ActionType],
+        }
+        # Only changes with the plugin version, so it is safe to cache across restarts
+        self.enums_etag = hashlib.sha1(json.dumps(self.enums).encode()).hexdigest()[:16]
+        self.credentials = CredentialStore()
+        for name in self.credentials.stats:
+            metrics.gauge(f"credentials_{name}", lambda name=name: self.credentials.stats[name])
+        self.connection = WyzeConnection(
+            on_change=self.on_connection_change,
+            logger=self._logger,
+            ttl=self._settings.get_float(["device_cache_ttl"]),
+            active_interval=self._settings.get_float(["device_poll_interval_active"]),
+            is_active=self.is_active,
+            on_state_change=self.on_device_state_change,
+            api=self.api,
+        )
+
+
+    @property
+    def wyze(self):
+        return self.connection.wyze
+
+
+    def is_active(self):
+        return self._printer.is_printing() or self._printer.is_paused() or self.scheduler.has_pending_actions()
+
+
+    def on_device_state_change(self, changes):
+        for device_mac, state in changes.items():
+            if state is not None and state["is_on"] is not None:
+                self.dispatcher.update_state(device_mac, state["is_on"])
+            self.health.update_online(device_mac, state["is_online"] if state is not None else None)
+        self.health.check()
+        if self.recovered_actions:
+            # A device that was missing when the journal was replayed may have just shown up
+            self.restore_pending_actions()
+        self._plugin_manager.send_plugin_message(
+            self._identifier,
+            dict(
+                type="device_state",
+                changes=changes,
+            ),
+        )
+
+
+    def on_connection_change(self, status):
+        if status["state"] == WyzeConnection.CONNECTED and self.recovered_actions:
+            self.restore_pending_actions()
+        self._plugin_manager.send_plugin_message(
+            self._identifier,
+            dict(
+                type="connection",
+                status=status,
+            ),
+        )
+
+
+    def on_pending_action_change(self, change, action):
+        if change == ActionScheduler.ADDED and self.wyze is not None:
+            # Switch the device poller to its faster interval
+            self.wyze.wake()
+        if hasattr(self, "journal"):
+            if change == ActionScheduler.ADDED:
+                self.journal.add(action)
+            else:
+                self.journal.remove(action.id)
+        self._plugin_manager.send_plugin_message(
+            self._identifier,
+            dict(
+                type="pending_action",
+                change=change,
+                action=action.to_dict(),
+            ),
+        )
+
+
+    def resolve_device(self, device_mac):
+        if (wyze := self.wyze) is None:
+            return None
+        return wyze.devices.get(device_mac)
+
+
+    def renew_session(self):
+        if (wyze := self.wyze) is not None:
+            wyze.renew_devices()
+
+
+    def probe_devices(self):
+        if self.wyze is not None:
+            self.wyze.refresh_devices()
+
+
+    def on_device_health_change(self, changes):
+        for device_mac, health in changes.items():
+            if health == DeviceHealth.HEALTHY:
+                self.dispatcher.resume(device_mac)
+        self._plugin_manager.send_plugin_message(
+            self._identifier,
+            dict(
+                type="device_health",
+                changes=changes,
+            ),
+        )
+
+
+    def expire_deferred_jobs(self):
+        self.dispatcher.expire_deferred()
+
+
+    def on_job_complete(self, job):
+        if job.status == Job.FAILED:
+            # A failure may have opened the device's circuit breaker
+            self.health.check()
+        self._plugin_manager.send_plugin_message(
+            self._identifier,
+            dict(
+                type="job",
+                job=job.to_dict(),
+            ),
+        )
 
 
     def on_after_startup(self):
         self.data_folder = self.get_plugin_data_folder()
-        self.event_handler = EventHandler(self.data_folder)
+        synchronous = self._settings.get(["db_synchronous"])
+        if str(synchronous).upper() not in Database.SYNCHRONOUS_LEVELS:
+            self._logger.warning(f"Invalid db_synchronous setting {synchronous!r}, using NORMAL.")
+            synchronous = "NORMAL"
+        self.event_handler = EventHandler(self.data_folder, synchronous=synchronous)
+        self.load_temperature_rules()
+        self.load_progress_rules()
+        self.journal = ActionJournal(self.event_handler.db, self._logger)
+        self.journal.start()
+        # Actions that were pending when OctoPrint stopped, rescheduled once the devices are known
+        self.recovered_actions = self.journal.load()
+        if self.recovered_actions:
+            Action.reserve_ids(max(entry[0] for entry in self.recovered_actions))
+        # Decrypts the stored credentials and starts logging in in the background
+        self.on_settings_load()
+
+
+    def restore_pending_actions(self):
+        with self._recovery_lock:
+            wyze = self.wyze
+            if wyze is None or not wyze.inventory_loaded:
+                return
+            drop_overdue = self._settings.get(["overdue_action_policy"]) == "drop"
+            now = time.time()
+            # Only the first replay and ones that made progress are logged, later ones run on every device change
+            report = not self._recovery_attempted
+            self._recovery_attempted = True
+            waiting = []
+            restored = 0
+            for entry in self.recovered_actions:
+                action_id, device_mac, event_type, action_type, deadline = entry
+                if (device := wyze.devices.get(device_mac)) is None:
+                    # Kept, journal entry included, until the device is in the inventory again
+                    waiting.append(entry)
+                    continue
+                # Rescheduled actions are journaled again under their new ids
+                self.journal.remove(action_id)
+                remaining = deadline - now
+                if remaining <= 0 and drop_overdue:
+                    self._logger.info(f"Dropping overdue {ActionType.get_name(action_type)} action for {device} from before the restart.")
+                    continue
+                self.scheduler.schedule(Action(action_type, event_type, device, max(0, remaining) / 60), if_idle=True)
+                restored += 1
+            self.recovered_actions = waiting
+        if restored:
+            self._logger.info(f"Replayed {restored} journaled pending actions from before the restart.")
+        if waiting and (report or restored):
+            self._logger.warning(f"Keeping {len(waiting)} journaled pending actions until their devices are seen again.")
+
+
+    def on_shutdown(self):
+        # Let events that were already queued schedule their actions first
+        self.event_queue.stop()
+        self.scheduler.stop()
+        self.health.stop()
+        self.dispatcher.shutdown()
+        self.connection.disconnect()
+        if hasattr(self, "journal"):
+            # Pending actions stay in the journal for the next start
+            self.journal.stop()
+        if hasattr(self, "event_handler"):
+            self.event_handler.close()
 
 
     def get_settings_defaults(self):
@@ -44,59 +305,55 @@ class WyzePlugin(
             wyze_api_key=None,
             wyze_key_id=None,
             wyze_key=None,
+            db_synchronous="NORMAL",
+            device_cache_ttl=300,
+            device_poll_interval_active=15,
+            max_command_workers=4,
+            command_coalesce_window=0.5,
+            device_state_ttl=60,
+            api_rate=2,
+            api_burst=5,
+            api_timeout=30,
+            api_socket_timeout=10,
+            api_max_attempts=4,
+            api_failure_threshold=3,
+            api_reset_timeout=60,
+            metrics_prometheus=False,
+            event_queue_size=100,
+            device_health_probe_interval=120,
+            defer_offline_commands=True,
+            offline_command_timeout=600,
+            overdue_action_policy="fire",
         )
 
 
+    def get_token_store(self, fernet):
+        return TokenStore(os.path.join(self.get_plugin_data_folder(), "wyze-session"), fernet)
+
+
     def on_settings_save(self, data):
         if "wyze_password" in data:
-            # email = self._settings.get(["wyze_email"])
-            email = data["wyze_email"]
-            # Encrypt the password and API key
-            password = data["wyze_password"]
-            api_key = data["wyze_api_key"]
-            key_id = data["wyze_key_id"]
-            key = Fernet.generate_key()
-            fernet = Fernet(key)
-            encrypted_password = fernet.encrypt(password.encode())
-            encrypted_api_key = fernet.encrypt(api_key.encode())
-            encrypted_key_id = fernet.encrypt(key_id.encode())
-            data["wyze_password"] = encrypted_password
-            data["wyze_api_key"] = encrypted_api_key
-            data["wyze_key_id"] = encrypted_key_id
+            email = data.get("wyze_email", self._settings.get(["wyze_email"]))
+            current = self.credentials.secrets or (None,) * len(CredentialStore.FIELDS)
+            secrets = tuple(data.get(field, value) for field, value in zip(CredentialStore.FIELDS, current))
+            # Only a changed secret gets a new key, so unrelated saves leave the stored ciphertexts alone
+            key, encrypted, _ = self.credentials.encrypt(secrets)
+            data.update(zip(CredentialStore.FIELDS, encrypted))
             data["wyze_key"] = key
-            # Try to connect to Wyze
-            self.wyze = Wyze(
-                email=email,
-                password=password,
-                api_key=api_key,
-                key_id=key_id,
-            )
+            # Unchanged credentials are ignored unless the last attempt failed, so this doubles as a retry
+            self.connection.connect(email, *secrets, token_store=self.get_token_store(self.credentials.fernet))
         SettingsPlugin.on_settings_save(self, data)
 
 
     def on_settings_load(self):
         data = SettingsPlugin.on_settings_load(self)
         if data["wyze_password"] is not None:
+            encrypted = tuple(data[field] for field in CredentialStore.FIELDS)
+            secrets, _ = self.credentials.decrypt(data["wyze_key"], encrypted)
+            data.update(zip(CredentialStore.FIELDS, secrets))
+            # connect() ignores unchanged credentials, and the email is not part of the cached secrets
             email = self._settings.get(["wyze_email"])
-            # Decrypt the password and API key
-            encrypted_password = data["wyze_password"]
-            encrypted_api_key = data["wyze_api_key"]
-            encrypted_key_id = data["wyze_key_id"]
-            key = data["wyze_key"]
-            fernet = Fernet(key)
-            password = fernet.decrypt(encrypted_password).decode()
-            api_key = fernet.decrypt(encrypted_api_key).decode()
-            key_id = fernet.decrypt(encrypted_key_id).decode()
-            data["wyze_password"] = password
-            data["wyze_api_key"] = api_key
-            data["wyze_key_id"] = key_id
-            # Try to connect to Wyze
-            self.wyze = Wyze(
-                email=email,
-                password=password,
-                api_key=api_key,
-                key_id=key_id,
-            )
+            self.connection.connect(email, *secrets, token_store=self.get_token_store(self.credentials.fernet))
         return data
 
     
@@ -122,45 +379,103 @@ class WyzePlugin(
         )
 
 
+    def devices_etag(self, wyze) -> str:
+        return f"{self.boot_id}-{wyze.version}-{self.health.version}-{self.event_handler.version}"
+
+
+    def jsonify_if_modified(self, etag, build):
+        """Answers 304 without calling build() when the client already holds etag."""
+        if etag in flask.request.if_none_match:
+            response = flask.Response(status=304)
+        else:
+            response = flask.jsonify(build())
+        response.set_etag(etag)
+        return response
+
+
     def get_api_commands(self):
         return dict(
             get_enums=[],
+            get_connection_status=[],
             get_devices=[],
+            refresh_devices=[],
             get_pending_actions=[],
             turn_on=["device_mac"],
             turn_off=["device_mac"],
+            get_job=["job_id"],
+            get_command_stats=[],
+            get_metrics=[],
             register=["device_mac", "event_name", "action_name"],
             unregister=["device_mac", "event_name", "action_name"],
             add_cancel=["device_mac", "event_name", "action_name"],
             remove_cancel=["device_mac", "event_name", "action_name"],
+            apply_registrations=["changes"],
+            export_rules=[],
+            import_rules=["rules"],
+            get_temperature_rules=[],
+            add_temperature_rule=["device_mac", "tool", "direction", "threshold", "action_name"],
+            remove_temperature_rule=["rule_id"],
+            get_progress_rules=[],
+            add_progress_rule=["device_mac", "progress", "action_name"],
+            remove_progress_rule=["rule_id"],
         )
 
 
     def on_api_command(self, command, data):
+        if command in ("refresh_devices", "turn_on", "turn_off") and self.wyze is None:
+            flask.abort(409, description="Not connected to Wyze.")
+        if command in ("register", "unregister", "add_cancel", "remove_cancel") and (
+            EventType.get_by_name(data["event_name"]) not in EventType.discrete() or ActionType.get_by_name(data["action_name"]) is None
+        ):
+            flask.abort(400, description="Unknown event or action.")
         if command == "get_enums":
             self._logger.info("Sending enums...")
-            enums = {
-                "events": [EventType.get_name(event) for event in EventType],
-                "actions": [ActionType.get_name(action) for action in ActionType],
-            }
-            return flask.jsonify(enums)
+            return self.jsonify_if_modified(self.enums_etag, lambda: self.enums)
+        elif command == "get_connection_status":
+            return flask.jsonify(self.connection.status())
         elif command == "get_devices":
             self._logger.info("Sending device info...")
-            devices = self.wyze.get_devices(self.event_handler)
-            return flask.jsonify(devices)
+            wyze = self.wyze
+            if wyze is None:
+                return flask.jsonify([])
+            return self.jsonify_if_modified(
+                self.devices_etag(wyze),
+                lambda: wyze.get_devices(self.event_handler, self.health),
+            )
+        elif command == "refresh_devices":
+            self._logger.info("Refreshing device inventory...")
+            self.wyze.refresh_devices()
+            # Taken before building the list, so a change made meanwhile makes the next load refetch
+            etag = self.devices_etag(self.wyze)
+            response = flask.jsonify(self.wyze.get_devices(self.event_handler, self.health))
+            response.set_etag(etag)
+            return response
         elif command == "get_pending_actions":
-            pending_actions = [str(action) for action in self.pending_actions]
+            if data.get("detailed", False):
+                pending_actions = [action.to_dict() for action in self.scheduler.pending_actions()]
+            else:
+                pending_actions = [str(action) for action in self.scheduler.pending_actions()]
             return flask.jsonify(pending_actions)
         elif command == "turn_on":
             device_mac = data["device_mac"]
             device = self.wyze.devices[device_mac]
             self._logger.info(f"Turning on Wyze {device.type} with device_mac={device_mac}...")
-            device.turn_on()
+            job = self.dispatcher.submit(device, "turn_on")
+            return flask.jsonify(job.to_dict())
         elif command == "turn_off":
             device_mac = data["device_mac"]
             device = self.wyze.devices[device_mac]
             self._logger.info(f"Turning off Wyze {device.type} with device_mac={device_mac}...")
-            device.turn_off()
+            job = self.dispatcher.submit(device, "turn_off")
+            return flask.jsonify(job.to_dict())
+        elif command == "get_job":
+            if (job := self.dispatcher.get_job(int(data["job_id"]))) is None:
+                flask.abort(404)
+            return flask.jsonify(job.to_dict())
+        elif command == "get_command_stats":
+            return flask.jsonify(self.dispatcher.get_stats())
+        elif command == "get_metrics":
+            return flask.jsonify(metrics.snapshot())
         elif command == "register":
             device_mac = data["device_mac"]
             event_name = data["event_name"]
@@ -179,13 +494,9 @@ class WyzePlugin(
             self._logger.info(f"Unregistering device_mac={device_mac} event={event_type} action={action_type}.")
             self.event_handler.unregister(device_mac, event_type, action_type)
             # Cancel any pending actions that match
-            matched_actions = []
-            for action in self.pending_actions:
-                if action.device.mac == device_mac and action.event_type == event_type and action.action_type == action_type:
-                    matched_actions.append(action)
-            for action in matched_actions:
+            for action in self.scheduler.registry.find(device_mac, event_type, action_type):
                 self._logger.info(f"Cancelling pending action {action}...")
-                action.cancel()
+                self.scheduler.cancel(action)
         elif command == "add_cancel":
             device_mac = data["device_mac"]
             event_name = data["event_name"]
@@ -202,22 +513,156 @@ class WyzePlugin(
             action_type = ActionType.get_by_name(action_name)
             self._logger.info(f"Removing cancellation device_mac={device_mac} event={event_type} action={action_type}.")
             self.event_handler.remove_cancel(device_mac, event_type, action_type)
+        elif command == "apply_registrations":
+            if not isinstance(data["changes"], list) or not all(isinstance(change, dict) for change in data["changes"]):
+                flask.abort(400, description="Changes must be a list of objects.")
+            changes = []
+            for change in data["changes"]:
+                if not change.get("device_mac"):
+                    flask.abort(400, description="Every change needs a device.")
+                event_type = EventType.get_by_name(change.get("event_name"))
+                action_type = ActionType.get_by_name(change.get("action_name"))
+                operation = change.get("operation")
+                if event_type not in EventType.discrete() or action_type is None or operation not in (
+                    EventHandler.REGISTER, EventHandler.UNREGISTER, EventHandler.ADD_CANCEL, EventHandler.REMOVE_CANCEL
+                ):
+                    flask.abort(400, description="Unknown operation, event or action.")
+                try:
+                    delay = float(change.get("delay") or 0)
+                except (TypeError, ValueError):
+                    flask.abort(400, description="Delay must be a number.")
+                changes.append((operation, change["device_mac"], event_type, action_type, delay))
+            self._logger.info(f"Applying {len(changes)} registration changes.")
+            self.event_handler.apply_registrations(changes)
+            self.cancel_unregistered_actions()
+        elif command == "export_rules":
+            return flask.jsonify(self.event_handler.export_rules())
+        elif command == "import_rules":
+            self._logger.info("Importing rules...")
+            try:
+                self.event_handler.import_rules(data["rules"])
+            except (AttributeError, KeyError, TypeError, ValueError) as e:
+                flask.abort(400, description=f"Invalid rule set: {e}")
+            self.load_temperature_rules()
+            self.load_progress_rules()
+            self.cancel_unregistered_actions()
+        elif command == "get_temperature_rules":
+            return flask.jsonify([rule.to_dict() for rule in self.temperature_monitor.rules()])
+        elif command == "add_temperature_rule":
+            try:
+                rule = parse_temperature_rule(data)
+            except (TypeError, ValueError) as e:
+                flask.abort(400, description=str(e))
+            self._logger.info(f"Adding temperature rule device_mac={rule['device_mac']} tool={rule['tool']} {rule['direction']} {rule['threshold']} action={rule['action']}.")
+            self.event_handler.add_temperature_rule(**rule)
+            self.load_temperature_rules()
+            return flask.jsonify([rule.to_dict() for rule in self.temperature_monitor.rules()])
+        elif command == "remove_temperature_rule":
+            self._logger.info(f"Removing temperature rule {data['rule_id']}.")
+            self.event_handler.remove_temperature_rule(int(data["rule_id"]))
+            self.load_temperature_rules()
+            return flask.jsonify([rule.to_dict() for rule in self.temperature_monitor.rules()])
+        elif command == "get_progress_rules":
+            return flask.jsonify([rule.to_dict() for rule in self.progress_monitor.rules()])
+        elif command == "add_progress_rule":
+            try:
+                rule = parse_progress_rule(data)
+            except (TypeError, ValueError) as e:
+                flask.abort(400, description=str(e))
+            self._logger.info(f"Adding progress rule device_mac={rule['device_mac']} progress={rule['progress']} action={rule['action']}.")
+            self.event_handler.add_progress_rule(**rule)
+            self.load_progress_rules()
+            return flask.jsonify([rule.to_dict() for rule in self.progress_monitor.rules()])
+        elif command == "remove_progress_rule":
+            self._logger.info(f"Removing progress rule {data['rule_id']}.")
+            self.event_handler.remove_progress_rule(int(data["rule_id"]))
+            self.load_progress_rules()
+            return flask.jsonify([rule.to_dict() for rule in self.progress_monitor.rules()])
+
+
+    def cancel_unregistered_actions(self):
+        # Trigger actions have no registration, only the ones from discrete events are checked
+        for action in self.scheduler.pending_actions():
+            if action.event_type not in EventType.discrete():
+                continue
+            if not self.event_handler.is_registered(action.device.mac, action.event_type, action.action_type):
+                self._logger.info(f"Cancelling pending action {action}...")
+                self.scheduler.cancel(action)
+
+
+    def load_temperature_rules(self):
+        self.temperature_monitor.load(TemperatureRule(**row) for row in self.event_handler.get_temperature_rules())
+
+
+    def load_progress_rules(self):
+        self.progress_monitor.load(ProgressRule(**row) for row in self.event_handler.get_progress_rules())
+
+
+    @BlueprintPlugin.route("/metrics", methods=["GET"])
+    def get_prometheus_metrics(self):
+        if not self._settings.get_boolean(["metrics_prometheus"]):
+            flask.abort(404)
+        return flask.Response(metrics.to_prometheus(), mimetype="text/plain; version=0.0.4")
+
+
+    def is_blueprint_csrf_protected(self):
+        return True
 
     
     def on_event(self, event_name, payload):
-        if not hasattr(self, "wyze") or not hasattr(self, "event_handler") or EventType.get_by_name(event_name) is None:
+        # OctoPrint calls this for every event it fires, so bail out as cheaply as possible
+        if (event_type := EventType.get_by_name(event_name)) is None or self.wyze is None or not hasattr(self, "event_handler"):
+            return
+        if event_type in (EventType.PRINT_STARTED, EventType.PRINT_RESUMED):
+            self.wyze.wake()
+        if event_type == EventType.PRINT_STARTED:
+            self.progress_monitor.reset()
+        if event_type in self.temperature_monitor.arm_events:
+            self.temperature_monitor.arm(event_type)
+        if not self.event_handler.is_subscribed(event_type):
             return
-        for device_mac in self.wyze.devices:
-            device = self.wyze.get_device_by_mac(device_mac)
+        # Keep the event bus moving; the database and scheduler work happens on the queue's thread
+        self.event_queue.put(event_type, event_name)
+
+
+    @metrics.timed("event_handling")
+    def handle_event(self, event_type, event_name):
+        # Only visit the devices with a registration or cancellation for this event
+        for device_mac in self.event_handler.get_subscribed_devices(event_type):
+            if (device := self.wyze.devices.get(device_mac)) is None:
+                continue
             # Cancel any pending actions that are supposed to be cancelled on this event
             self.event_handler.process_cancellations(self, device, event_name)
             # Add event handlers for any registerations that match this event
-            if (action := self.event_handler.get_action(self, device, event_name)) is None:
+            if (action := self.event_handler.get_action(device, event_name)) is None:
                 continue
-            if any(action.device == device for action in self.pending_actions):
-                continue
-            self.pending_actions.append(action)
-            action.start()
+            # Skipped when the device already has an action pending
+            self.scheduler.schedule(action, if_idle=True)
+
+
+    def on_temperatures_received(self, comm, parsed_temperatures, *args, **kwargs):
+        # Runs on the comm thread several times a second: evaluate in place, hand triggers off
+        try:
+            self.temperature_monitor.process(parsed_temperatures)
+        except Exception:
+            self._logger.exception("Failed to evaluate temperature rules.")
+        return parsed_temperatures
+
+
+    def on_print_progress(self, storage, path, progress):
+        self.progress_monitor.process(progress)
+
+
+    def on_trigger(self, rule):
+        # Called from the comm thread, so only hand the rule off here
+        self.event_queue.submit(f"rule {rule}", self.handle_trigger, rule)
+
+
+    def handle_trigger(self, rule):
+        if self.wyze is None or (device := self.wyze.devices.get(rule.device_mac)) is None:
+            return
+        self._logger.info(f"Rule {rule} triggered for {device}.")
+        self.scheduler.schedule(Action(rule.action_type, rule.event_type, device, rule.delay), if_idle=True)
 
 
     def get_update_information(self):
@@ -241,6 +686,7 @@ def __plugin_load__():
     __plugin_implementation__ = WyzePlugin()
     
     global __plugin_hooks__ 
-    __plugin_hooks = {
+    __plugin_hooks__ = {
         "octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information,
+        "octoprint.comm.protocol.temperatures.received": __plugin_implementation__.on_temperatures_received,
     }
@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+import logging
+import random
+import time
+
+from collections import defaultdict
+from threading import Lock, Thread
+from typing import Callable, Dict, List, Optional
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class DeadlineExceededError(Exception):
+    pass
+
+
+def is_retryable(error: Exception) -> bool:
+    response = getattr(error, "response", None)
+    if (status_code := getattr(response, "status_code", None)) is not None:
+        return status_code == 429 or status_code >= 500
+    # requests' connection errors and timeouts are all OSErrors
+    return isinstance(error, OSError)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float, clock: Callable[[], float] = time.monotonic, sleep: Callable[[float], None] = time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = capacity
+        self._updated = clock()
+        self._lock = Lock()
+
+    def _reserve(self) -> float:
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        deadline = None if timeout is None else self._clock() + timeout
+        while (wait := self._reserve()) > 0:
+            if deadline is not None and self._clock() + wait > deadline:
+                return False
+            self._sleep(wait)
+        return True
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 60, clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = Lock()
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self.opened_at is None:
+                return self.CLOSED
+            if self._clock() - self.opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self.OPEN
+
+    def allow(self) -> bool:
+        # Half-open lets calls through again; the next failure re-opens it
+        return self.state != self.OPEN
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = self._clock()
+
+
+class ApiClient:
+    def __init__(
+        self,
+        rate: float = 2,
+        burst: float = 5,
+        timeout: float = 30,
+        socket_timeout: float = 10,
+        max_abandoned: int = 4,
+        max_attempts: int = 4,
+        base_delay: float = 0.5,
+        max_delay: float = 8,
+        failure_threshold: int = 3,
+        reset_timeout: float = 60,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+        logger=None,
+    ):
+        self._logger = logger or logging.getLogger(__name__)
+        self.timeout = timeout
+        # Applied to every HTTP request wyze_sdk makes, see wyze_devices.install_socket_timeout
+        self.socket_timeout = socket_timeout
+        self.max_abandoned = max_abandoned
+        self._abandoned: List[Thread] = []
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._clock = clock
+        self._sleep = sleep
+        self.bucket = TokenBucket(rate, burst, clock=clock, sleep=sleep)
+        self._lock = Lock()
+        self._breakers: Dict[str, CircuitBreaker] = defaultdict(
+            lambda: CircuitBreaker(failure_threshold, reset_timeout, clock=clock)
+        )
+
+    def breaker(self, circuit: str) -> CircuitBreaker:
+        return self._breakers[circuit]
+
+    def circuit_state(self, circuit: str) -> str:
+        # Doesn't create a breaker for circuits that were never called
+        if (breaker := self._breakers.get(circuit)) is None:
+            return CircuitBreaker.CLOSED
+        return breaker.state
+
+    def call(self, function: Callable, *args, circuit: Optional[str] = None, **kwargs):
+        breaker = self._breakers[circuit] if circuit is not None else None
+        if breaker is not None and not breaker.allow():
+            raise CircuitOpenError(f"Too many recent failures for {circuit}, not calling the Wyze API.")
+        deadline = self._clock() + self.timeout
+        attempt = 0
+        while True:
+            attempt += 1
+            if not self.bucket.acquire(deadline - self._clock()):
+                raise DeadlineExceededError(f"Rate limited for longer than {self.timeout} seconds.")
+            try:
+                result = self._invoke(function, args, kwargs, deadline - self._clock())
+            except Exception as e:
+                if isinstance(e, DeadlineExceededError) or not is_retryable(e) or attempt >= self.max_attempts:
+                    if breaker is not None:
+                        breaker.record_failure()
+                    raise
+                # Exponential backoff with full jitter, bounded by the call's deadline
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+                if self._clock() + delay > deadline:
+                    if breaker is not None:
+                        breaker.record_failure()
+                    raise
+                self._logger.info(f"Wyze API call failed ({e}), retrying in {delay:.1f} seconds...")
+                self._sleep(delay)
+                continue
+            if breaker is not None:
+                breaker.record_success()
+            return result
+
+    def _invoke(self, function: Callable, args, kwargs, timeout: float):
+        # A call that stalls despite the socket timeout (DNS, say) is abandoned
+        # on a daemon thread once the deadline passes. Only a few may pile up,
+        # after that calls fail fast until one of them returns.
+        with self._lock:
+            self._abandoned = [thread for thread in self._abandoned if thread.is_alive()]
+            if len(self._abandoned) >= self.max_abandoned:
+                raise DeadlineExceededError(f"{len(self._abandoned)} earlier Wyze API calls are still stalled.")
+        outcome = {}
+
+        def target():
+            try:
+                outcome["result"] = function(*args, **kwargs)
+            except BaseException as e:
+                outcome["error"] = e
+
+        thread = Thread(target=target, daemon=True, name="WyzeApiCall")
+        thread.start()
+        thread.join(max(0, timeout))
+        if thread.is_alive():
+            with self._lock:
+                self._abandoned.append(thread)
+            raise DeadlineExceededError(f"Wyze API call did not finish within {self.timeout} seconds.")
+        if "error" in outcome:
+            raise outcome["error"]
+        return outcome["result"]
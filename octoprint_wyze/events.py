@@ -1,17 +1,22 @@
 from __future__ import annotations
 from collections import defaultdict
 
+import heapq
+import itertools
 import os
 import sqlite3
 import time
 
 from contextlib import contextmanager
 from enum import IntEnum, auto
-from threading import Thread
-from typing import Optional, List, Tuple, TYPE_CHECKING
+from queue import Full, Queue
+from threading import Condition, Lock, RLock, Thread
+from typing import Callable, Dict, FrozenSet, Optional, List, Tuple, TYPE_CHECKING
+
+from .metrics import metrics
 
 if TYPE_CHECKING:
-    from .wyze_devices import WyzeDevice
+    from .wyze_devices import CommandDispatcher, WyzeDevice
 
 
 class EventType(IntEnum):
@@ -26,6 +31,9 @@ class EventType(IntEnum):
     CAPTURE_START = auto()
     CAPTURE_DONE = auto()
     CAPTURE_FAILED = auto()
+    # Raised by trigger rules rather than by OctoPrint
+    TEMPERATURE = auto()
+    PROGRESS = auto()
 
 
     @classmethod
@@ -42,24 +50,25 @@ class EventType(IntEnum):
             cls.CAPTURE_START: "CaptureStart",
             cls.CAPTURE_DONE: "CaptureDone",
             cls.CAPTURE_FAILED: "CaptureFailed",
+            cls.TEMPERATURE: "Temperature",
+            cls.PROGRESS: "Progress",
         }
 
 
+    @classmethod
+    def discrete(cls) -> List[EventType]:
+        """The OctoPrint events that make up the columns of the registration table."""
+        return _DISCRETE_EVENTS
+
+
     @classmethod
     def get_by_name(cls, event_name: str) -> Optional[EventType]:
-        reversed_names = {v: k for k, v in cls.names().items()}
-        try:
-            return reversed_names[event_name]
-        except KeyError:
-            return None
+        return _EVENT_TYPES_BY_NAME.get(event_name)
 
 
     @classmethod
     def get_name(cls, event: EventType) -> Optional[str]:
-        try:
-            return cls.names()[event]
-        except KeyError:
-            return None
+        return _EVENT_NAMES.get(event)
 
 
 class ActionType(IntEnum):
@@ -77,78 +86,484 @@ class ActionType(IntEnum):
 
     @classmethod
     def get_by_name(cls, action_name: str) -> Optional[ActionType]:
-        reversed_names = {v: k for k, v in cls.names().items()}
-        try:
-            return reversed_names[action_name]
-        except KeyError:
-            return None
+        return _ACTION_TYPES_BY_NAME.get(action_name)
 
 
     @classmethod
     def get_name(cls, action: ActionType) -> Optional[str]:
-        try:
-            return cls.names()[action]
-        except KeyError:
-            return None
+        return _ACTION_NAMES.get(action)
+
+
+# Built once at import time; OctoPrint looks up every event it fires by name
+_EVENT_NAMES = EventType.names()
+_EVENT_TYPES_BY_NAME = {name: event for event, name in _EVENT_NAMES.items()}
+_ACTION_NAMES = ActionType.names()
+_ACTION_TYPES_BY_NAME = {name: action for action, name in _ACTION_NAMES.items()}
+_DISCRETE_EVENTS = [event for event in EventType if event < EventType.TEMPERATURE]
+
+
+class Action:
+    __slots__ = ("id", "action_type", "action_name", "event_type", "device", "delay", "deadline", "cancelled", "fired")
 
+    _ids = itertools.count(1)
 
-class Action(Thread):
-    def __init__(self, plugin, action_type: ActionType, event_type: EventType, device: WyzeDevice, delay: float = 0):
-        super().__init__(daemon=True)
+    @classmethod
+    def reserve_ids(cls, last_id: int):
+        # Keeps new ids clear of the ones in the journal from the last run
+        cls._ids = itertools.count(max(next(cls._ids), last_id + 1))
+
+
+    def __init__(self, action_type: ActionType, event_type: EventType, device: WyzeDevice, delay: float = 0):
+        self.id = next(self._ids)
         self.action_type = action_type
         self.action_name = "turn on" if action_type == ActionType.TURN_ON else "turn off"
         self.event_type = event_type
         self.device = device
-        self.plugin = plugin
-        self.delay = delay
-        self.device = device
         self.delay = delay * 60 # Convert minutes to seconds
-        self.time_remaining = self.delay
-        self.plugin = plugin
-        self._cancel = False
+        self.deadline = time.monotonic() + self.delay
+        self.cancelled = False
+        self.fired = False
 
 
-    def run(self):
-        start = time.time()
-        while time.time() - start < self.delay:
-            if self._cancel:
-                break
-            self.time_remaining = self.delay - (time.time() - start)
-            time.sleep(0.5)
-        if not self._cancel:
-            if self.action_type == ActionType.TURN_ON:
-                self.device.turn_on()
-            elif self.action_type == ActionType.TURN_OFF:
-                self.device.turn_off()
-            self.plugin.pending_actions.remove(self)
+    @property
+    def time_remaining(self) -> float:
+        return max(0, self.deadline - time.monotonic())
+
+
+    @property
+    def command(self) -> str:
+        return "turn_on" if self.action_type == ActionType.TURN_ON else "turn_off"
+
+
+    def to_dict(self) -> Dict:
+        time_remaining = self.time_remaining
+        return {
+            "id": self.id,
+            "event_name": EventType.get_name(self.event_type),
+            "action_name": self.action_name,
+            "device_mac": self.device.mac,
+            "device_name": str(self.device),
+            "time_remaining": time_remaining,
+            "deadline": time.time() + time_remaining,
+        }
 
 
-    def cancel(self):
-        self._cancel = True
-        self.plugin.pending_actions.remove(self)
+    def fire(self):
+        if self.action_type == ActionType.TURN_ON:
+            self.device.turn_on()
+        elif self.action_type == ActionType.TURN_OFF:
+            self.device.turn_off()
 
 
     def __str__(self):
         return f"{EventType.get_name(self.event_type)}: {self.device} will {self.action_name} in {round(self.time_remaining)} seconds."
 
 
+class PendingActionRegistry:
+    """
+    The set of actions that are scheduled but have neither fired nor been
+    cancelled, indexed by (device_mac, event, action) and by device_mac. Every
+    transition happens under one lock, so an action is added, cancelled or
+    completed exactly once no matter which thread gets there first.
+    """
+
+    def __init__(self):
+        self._lock = RLock()
+        self._by_key: Dict[Tuple[str, EventType, ActionType], Dict[int, Action]] = {}
+        self._by_mac: Dict[str, Dict[int, Action]] = {}
+
+
+    def add(self, action: Action, if_idle: bool = False) -> bool:
+        with self._lock:
+            # if_idle keeps at most one pending action per device
+            if if_idle and action.device.mac in self._by_mac:
+                return False
+            self._by_key.setdefault(self._key(action), {})[action.id] = action
+            self._by_mac.setdefault(action.device.mac, {})[action.id] = action
+            return True
+
+
+    def cancel(self, action: Action) -> bool:
+        with self._lock:
+            if not self._remove(action):
+                return False
+            action.cancelled = True
+            return True
+
+
+    def complete(self, action: Action) -> bool:
+        with self._lock:
+            if not self._remove(action):
+                return False
+            action.fired = True
+            return True
+
+
+    def find(self, device_mac: str, event: EventType, action: ActionType) -> List[Action]:
+        with self._lock:
+            return list(self._by_key.get((device_mac, event, action), {}).values())
+
+
+    def for_device(self, device_mac: str) -> List[Action]:
+        with self._lock:
+            return list(self._by_mac.get(device_mac, {}).values())
+
+
+    def snapshot(self) -> List[Action]:
+        with self._lock:
+            actions = [action for actions in self._by_mac.values() for action in actions.values()]
+        return sorted(actions, key=lambda action: (action.deadline, action.id))
+
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+
+    def __len__(self) -> int:
+        with self._lock:
+            return sum(len(actions) for actions in self._by_mac.values())
+
+
+    @staticmethod
+    def _key(action: Action) -> Tuple[str, EventType, ActionType]:
+        return action.device.mac, action.event_type, action.action_type
+
+
+    def _remove(self, action: Action) -> bool:
+        key = self._key(action)
+        if self._by_key.get(key, {}).pop(action.id, None) is None:
+            return False
+        if not self._by_key[key]:
+            del self._by_key[key]
+        actions = self._by_mac[action.device.mac]
+        del actions[action.id]
+        if not actions:
+            del self._by_mac[action.device.mac]
+        return True
+
+
+class ActionScheduler(Thread):
+    ADDED = "added"
+    CANCELLED = "cancelled"
+    FIRED = "fired"
+
+    def __init__(self, logger, on_change: Optional[Callable[[str, Action], None]] = None, dispatcher: Optional[CommandDispatcher] = None):
+        super().__init__(daemon=True, name="WyzeActionScheduler")
+        self._logger = logger
+        self._dispatcher = dispatcher
+        self._on_change = on_change
+        self.registry = PendingActionRegistry()
+        # Heap of (deadline, sequence number, action). Cancelled actions are
+        # marked and left in place, then discarded when they reach the top.
+        self._heap: List[Tuple[float, int, Action]] = []
+        self._counter = itertools.count()
+        self._cancelled = 0
+        self._condition = Condition()
+        self._stopped = False
+
+
+    def schedule(self, action: Action, if_idle: bool = False) -> bool:
+        if not self.registry.add(action, if_idle):
+            return False
+        with self._condition:
+            heapq.heappush(self._heap, (action.deadline, next(self._counter), action))
+            self._condition.notify()
+        self._notify(self.ADDED, action)
+        return True
+
+
+    def cancel(self, action: Action) -> bool:
+        if not self.registry.cancel(action):
+            return False
+        with self._condition:
+            self._cancelled += 1
+            # Compact the heap once most of it is dead weight
+            if self._cancelled > len(self._heap) // 2:
+                self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+                heapq.heapify(self._heap)
+                self._cancelled = 0
+            self._condition.notify()
+        self._notify(self.CANCELLED, action)
+        return True
+
+
+    def has_pending_actions(self) -> bool:
+        return len(self.registry) > 0
+
+
+    def pending_actions(self) -> List[Action]:
+        return self.registry.snapshot()
+
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+
+    def _next_due(self) -> Optional[Action]:
+        with self._condition:
+            while not self._stopped:
+                while self._heap and self._heap[0][2].cancelled:
+                    heapq.heappop(self._heap)
+                    self._cancelled -= 1
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                timeout = self._heap[0][0] - time.monotonic()
+                if timeout > 0:
+                    self._condition.wait(timeout)
+                    continue
+                _, _, action = heapq.heappop(self._heap)
+                # Loses to a cancel that got there first
+                if not self.registry.complete(action):
+                    self._cancelled -= 1
+                    continue
+                return action
+            return None
+
+
+    def _notify(self, change: str, action: Action):
+        if self._on_change is None:
+            return
+        try:
+            self._on_change(change, action)
+        except Exception:
+            self._logger.exception(f"Failed to report {change} pending action {action}.")
+
+
+    def run(self):
+        while (action := self._next_due()) is not None:
+            self._notify(self.FIRED, action)
+            # Share the command pool with manual commands when there is one
+            if self._dispatcher is not None:
+                self._dispatcher.submit(action.device, action.command, suppress=True)
+                continue
+            try:
+                action.fire()
+            except Exception:
+                self._logger.exception(f"Failed to {action.action_name} {action.device}.")
+
+
+class EventQueue(Thread):
+    """
+    Hands events, and work from hooks such as temperature triggers, off to a
+    single consumer thread. One consumer keeps everything in arrival order,
+    and so in order per device.
+    When the queue is full new events are dropped and counted rather than
+    blocking the bus.
+    """
+
+    _STOP = object()
+
+    def __init__(self, handler: Callable[[EventType, str], None], logger, maxsize: int = 100):
+        super().__init__(daemon=True, name="WyzeEventQueue")
+        self._handler = handler
+        self._logger = logger
+        self._queue: Queue = Queue(maxsize)
+        # submit() runs on both the event bus and the comm thread
+        self._lock = Lock()
+        self._overflowing = False
+        self.stats = {
+            "queued": 0,
+            "processed": 0,
+            "failed": 0,
+            "dropped": 0,
+        }
+
+
+    def put(self, event_type: EventType, event_name: str) -> bool:
+        return self.submit(event_name, self._handler, event_type, event_name)
+
+
+    def submit(self, name: str, function: Callable, *args) -> bool:
+        try:
+            self._queue.put_nowait((name, function, args))
+        except Full:
+            with self._lock:
+                self.stats["dropped"] += 1
+                # Warn once per burst; the dropped counter keeps the total
+                warn, self._overflowing = not self._overflowing, True
+            if warn:
+                self._logger.warning(f"Event queue is full, dropping {name} and any further events until it drains.")
+            return False
+        with self._lock:
+            self._overflowing = False
+            self.stats["queued"] += 1
+        return True
+
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+
+    def stop(self, timeout: float = 5):
+        # Queued events are handled before the stop marker is reached
+        try:
+            self._queue.put(self._STOP, timeout=timeout)
+        except Full:
+            self._logger.warning("Event queue did not drain before shutdown.")
+            return
+        self.join(timeout)
+
+
+    def run(self):
+        while (item := self._queue.get()) is not self._STOP:
+            name, function, args = item
+            try:
+                function(*args)
+            except Exception:
+                with self._lock:
+                    self.stats["failed"] += 1
+                self._logger.exception(f"Failed to handle {name}.")
+            else:
+                with self._lock:
+                    self.stats["processed"] += 1
+
+
+class Database:
+    SYNCHRONOUS_LEVELS = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+    def __init__(self, db_path: str, synchronous: str = "NORMAL"):
+        synchronous = synchronous.upper()
+        if synchronous not in self.SYNCHRONOUS_LEVELS:
+            raise ValueError(f"Invalid synchronous level {synchronous}, must be one of {self.SYNCHRONOUS_LEVELS}.")
+        self.db_path = db_path
+        # A single long-lived connection shared by every thread, serialized by the lock.
+        # sqlite3's default cache of 128 prepared statements already covers every query here.
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = RLock()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(f"PRAGMA synchronous={synchronous}")
+
+
+    @contextmanager
+    def read(self):
+        with self._lock:
+            cur = self._conn.cursor()
+            try:
+                yield cur
+            finally:
+                cur.close()
+
+
+    @contextmanager
+    def write(self):
+        with self._lock:
+            cur = self._conn.cursor()
+            try:
+                yield cur
+            except BaseException:
+                self._conn.rollback()
+                raise
+            else:
+                self._conn.commit()
+            finally:
+                cur.close()
+
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class Rule:
+    __slots__ = ("registered", "delay", "cancel")
+
+    def __init__(self, registered: bool = False, delay: float = 0, cancel: bool = False):
+        self.registered = registered
+        self.delay = delay
+        self.cancel = cancel
+
+
+TEMPERATURE_ABOVE = "above"
+TEMPERATURE_BELOW = "below"
+
+
+def parse_temperature_rule(rule: Dict) -> Dict:
+    """
+    Checks a temperature rule as sent to the API or found in an export and
+    returns it as add_temperature_rule's keyword arguments.
+    """
+    if not rule.get("device_mac") or not rule.get("tool"):
+        raise ValueError("A temperature rule needs a device and a tool.")
+    if (action := ActionType.get_by_name(rule.get("action_name"))) is None:
+        raise ValueError(f"Unknown action {rule.get('action_name')}.")
+    if rule.get("direction") not in (TEMPERATURE_ABOVE, TEMPERATURE_BELOW):
+        raise ValueError(f"Unknown direction {rule.get('direction')}.")
+    after_event = None
+    if rule.get("after_event"):
+        if (after_event := EventType.get_by_name(rule["after_event"])) not in EventType.discrete():
+            raise ValueError(f"Unknown event {rule['after_event']}.")
+    try:
+        threshold = float(rule["threshold"])
+        hysteresis = float(rule.get("hysteresis", 2))
+        debounce = float(rule.get("debounce", 5))
+        delay = float(rule.get("delay") or 0)
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("Threshold, hysteresis, debounce and delay must be numbers.")
+    return dict(
+        device_mac=rule["device_mac"],
+        tool=rule["tool"],
+        direction=rule["direction"],
+        threshold=threshold,
+        action=action,
+        hysteresis=hysteresis,
+        debounce=debounce,
+        delay=delay,
+        after_event=after_event,
+    )
+
+
+def parse_progress_rule(rule: Dict) -> Dict:
+    """
+    Checks a progress rule as sent to the API or found in an export and
+    returns it as add_progress_rule's keyword arguments.
+    """
+    if not rule.get("device_mac"):
+        raise ValueError("A progress rule needs a device.")
+    if (action := ActionType.get_by_name(rule.get("action_name"))) is None:
+        raise ValueError(f"Unknown action {rule.get('action_name')}.")
+    try:
+        progress = int(rule["progress"])
+        delay = float(rule.get("delay") or 0)
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("Progress and delay must be numbers.")
+    if not 0 <= progress <= 100:
+        raise ValueError("Progress must be between 0 and 100.")
+    return dict(device_mac=rule["device_mac"], progress=progress, action=action, delay=delay)
+
+
 class EventHandler:
-    def __init__(self, data_folder: str):
+    REGISTER = "register"
+    UNREGISTER = "unregister"
+    ADD_CANCEL = "add_cancel"
+    REMOVE_CANCEL = "remove_cancel"
+
+    EXPORT_VERSION = 1
+
+    def __init__(self, data_folder: str, synchronous: str = "NORMAL"):
         self.db_path = os.path.join(data_folder, "wyze-event-handler-v2.db")
+        self.db = Database(self.db_path, synchronous)
+        # In-memory copy of the database, keyed by event -> device_mac -> action -> rule
+        self._index: Dict[EventType, Dict[str, Dict[ActionType, Rule]]] = defaultdict(dict)
+        # Events with at least one registration or cancellation, replaced whole on every change
+        self.subscribed_events: FrozenSet[EventType] = frozenset()
+        # Bumped on every change to registrations or rules, so clients can tell
+        # whether what they fetched last is still current
+        self._versions = itertools.count(1)
+        self.version = 0
+        self._lock = RLock()
         self.create_tables()
+        self.load_index()
 
-    
-    @contextmanager
-    def db_conn(self):
-        conn = sqlite3.connect(self.db_path)
-        cur = conn.cursor()
-        yield cur
-        conn.commit()
-        conn.close()
+
+    def close(self):
+        self.db.close()
 
 
     def create_tables(self):
-        with self.db_conn() as cur:
+        with self.db.write() as cur:
             cur.execute(
                 """
                     CREATE TABLE IF NOT EXISTS
@@ -161,6 +576,19 @@ class EventHandler:
                         )
                 """
             )
+            cur.execute(
+                """
+                    CREATE TABLE IF NOT EXISTS
+                        pending_actions
+                        (
+                            id integer PRIMARY KEY,
+                            device_mac text,
+                            event_name text,
+                            action_name text,
+                            deadline real
+                        )
+                """
+            )
             cur.execute(
                 """
                     CREATE UNIQUE INDEX IF NOT EXISTS
@@ -198,139 +626,515 @@ class EventHandler:
                     )
                 """
             )
+            cur.execute(
+                """
+                    CREATE TABLE IF NOT EXISTS
+                        temperature_rules
+                        (
+                            id integer PRIMARY KEY,
+                            device_mac text,
+                            tool text,
+                            direction text,
+                            threshold real,
+                            hysteresis real,
+                            debounce real,
+                            action_name text,
+                            delay real,
+                            after_event text
+                        )
+                """
+            )
+            cur.execute(
+                """
+                    CREATE TABLE IF NOT EXISTS
+                        progress_rules
+                        (
+                            id integer PRIMARY KEY,
+                            device_mac text,
+                            progress integer,
+                            action_name text,
+                            delay real
+                        )
+                """
+            )
 
 
+    @metrics.timed("db_load_index")
+    def load_index(self):
+        index = defaultdict(dict)
+        with self.db.read() as cur:
+            for device_mac, event_name, action_name, delay in cur.execute(
+                """
+                    SELECT * FROM
+                        registrations
+                """
+            ):
+                event_type = EventType.get_by_name(event_name)
+                action_type = ActionType.get_by_name(action_name)
+                if event_type is None or action_type is None:
+                    continue
+                rule = index[event_type].setdefault(device_mac, {}).setdefault(action_type, Rule())
+                rule.registered = True
+                rule.delay = delay
+            for device_mac, event_name, action_name in cur.execute(
+                """
+                    SELECT * FROM
+                        cancellations
+                """
+            ):
+                event_type = EventType.get_by_name(event_name)
+                action_type = ActionType.get_by_name(action_name)
+                if event_type is None or action_type is None:
+                    continue
+                rule = index[event_type].setdefault(device_mac, {}).setdefault(action_type, Rule())
+                rule.cancel = True
+        with self._lock:
+            self._index = index
+            self._index_changed()
+
+
+    def _index_changed(self):
+        self.subscribed_events = frozenset(event for event, devices in self._index.items() if devices)
+        self.version = next(self._versions)
+
+
+    def is_subscribed(self, event: EventType) -> bool:
+        return event in self.subscribed_events
+
+
+    def is_registered(self, device_mac: str, event: EventType, action: ActionType) -> bool:
+        with self._lock:
+            rule = self._index.get(event, {}).get(device_mac, {}).get(action)
+            return rule is not None and rule.registered
+
+
+    def _get_rule(self, device_mac: str, event: EventType, action: ActionType) -> Rule:
+        return self._index[event].setdefault(device_mac, {}).setdefault(action, Rule())
+
+
+    def _prune_rule(self, device_mac: str, event: EventType, action: ActionType):
+        rules = self._index[event].get(device_mac)
+        if rules is None or action not in rules:
+            return
+        if not rules[action].registered and not rules[action].cancel:
+            del rules[action]
+        if not rules:
+            del self._index[event][device_mac]
+        if not self._index[event]:
+            del self._index[event]
+
+
+    @metrics.timed("db_apply_registrations")
+    def apply_registrations(self, changes: List[Tuple[str, str, EventType, ActionType, float]]):
+        """Applies (operation, device_mac, event, action, delay) changes in one transaction."""
+        with self._lock:
+            with self.db.write() as cur:
+                for operation, device_mac, event, action, delay in changes:
+                    names = (device_mac, EventType.get_name(event), ActionType.get_name(action))
+                    if operation == self.REGISTER:
+                        cur.execute(
+                            """
+                                INSERT OR REPLACE INTO
+                                    registrations
+                                VALUES
+                                    (?, ?, ?, ?)
+                            """,
+                            names + (delay, )
+                        )
+                    elif operation == self.UNREGISTER:
+                        cur.execute(
+                            """
+                                DELETE FROM
+                                    registrations
+                                WHERE
+                                    device_mac = ?
+                                    AND
+                                    event_name = ?
+                                    AND 
+                                    action_name = ?
+                            """,
+                            names
+                        )
+                    elif operation == self.ADD_CANCEL:
+                        cur.execute(
+                            """
+                                INSERT OR IGNORE INTO
+                                    cancellations
+                                VALUES
+                                    (?, ?, ?)
+                            """,
+                            names
+                        )
+                    elif operation == self.REMOVE_CANCEL:
+                        cur.execute(
+                            """
+                                DELETE FROM
+                                    cancellations
+                                WHERE
+                                    device_mac = ?
+                                    AND
+                                    event_name = ?
+                                    AND 
+                                    action_name = ?
+                            """,
+                            names
+                        )
+                    else:
+                        raise ValueError(f"Unknown registration change {operation}.")
+            # Only touch the index once the transaction has committed
+            for operation, device_mac, event, action, delay in changes:
+                rule = self._get_rule(device_mac, event, action)
+                if operation == self.REGISTER:
+                    rule.registered = True
+                    rule.delay = delay
+                elif operation == self.UNREGISTER:
+                    rule.registered = False
+                    rule.delay = 0
+                elif operation == self.ADD_CANCEL:
+                    rule.cancel = True
+                else:
+                    rule.cancel = False
+                self._prune_rule(device_mac, event, action)
+            self._index_changed()
+
+
+    @metrics.timed("db_register")
     def register(self, device_mac: str, event: EventType, action: ActionType, delay: float = 0):
-        with self.db_conn() as cur:
-            try:
-                cur.execute(
+        self.apply_registrations([(self.REGISTER, device_mac, event, action, delay)])
+
+
+    @metrics.timed("db_unregister")
+    def unregister(self, device_mac: str, event: EventType, action: ActionType):
+        self.apply_registrations([(self.UNREGISTER, device_mac, event, action, 0)])
+
+
+    @metrics.timed("db_add_cancel")
+    def add_cancel(self, device_mac: str, event: EventType, action: ActionType):
+        self.apply_registrations([(self.ADD_CANCEL, device_mac, event, action, 0)])
+
+
+    @metrics.timed("db_remove_cancel")
+    def remove_cancel(self, device_mac: str, event: EventType, action: ActionType):
+        self.apply_registrations([(self.REMOVE_CANCEL, device_mac, event, action, 0)])
+
+
+    @metrics.timed("db_export_rules")
+    def export_rules(self) -> Dict:
+        registrations = []
+        cancellations = []
+        with self.db.read() as cur:
+            for device_mac, event_name, action_name, delay in cur.execute(
+                """
+                    SELECT * FROM
+                        registrations
+                """
+            ):
+                registrations.append({
+                    "device_mac": device_mac,
+                    "event_name": event_name,
+                    "action_name": action_name,
+                    "delay": delay,
+                })
+            for device_mac, event_name, action_name in cur.execute(
+                """
+                    SELECT * FROM
+                        cancellations
+                """
+            ):
+                cancellations.append({
+                    "device_mac": device_mac,
+                    "event_name": event_name,
+                    "action_name": action_name,
+                })
+        temperature_rules = []
+        for rule in self.get_temperature_rules():
+            rule = dict(rule)
+            del rule["id"]
+            rule["action_name"] = ActionType.get_name(rule.pop("action_type"))
+            rule["after_event"] = EventType.get_name(rule["after_event"]) if rule["after_event"] is not None else None
+            temperature_rules.append(rule)
+        progress_rules = []
+        for rule in self.get_progress_rules():
+            rule = dict(rule)
+            del rule["id"]
+            rule["action_name"] = ActionType.get_name(rule.pop("action_type"))
+            progress_rules.append(rule)
+        return {
+            "version": self.EXPORT_VERSION,
+            "registrations": registrations,
+            "cancellations": cancellations,
+            "temperature_rules": temperature_rules,
+            "progress_rules": progress_rules,
+        }
+
+
+    @metrics.timed("db_import_rules")
+    def import_rules(self, rules: Dict):
+        """Replaces every registration, cancellation and trigger rule with `rules`, as made by export_rules."""
+        if rules.get("version") != self.EXPORT_VERSION:
+            raise ValueError(f"Unsupported rule set version {rules.get('version')}.")
+        for rule in rules.get("registrations", []) + rules.get("cancellations", []):
+            if not rule.get("device_mac"):
+                raise ValueError("Every registration and cancellation needs a device.")
+            if EventType.get_by_name(rule.get("event_name")) not in EventType.discrete():
+                raise ValueError(f"Unknown event {rule.get('event_name')}.")
+            if ActionType.get_by_name(rule.get("action_name")) is None:
+                raise ValueError(f"Unknown action {rule.get('action_name')}.")
+        # The same checks add_temperature_rule and add_progress_rule get from the API
+        temperature_rules = [parse_temperature_rule(rule) for rule in rules.get("temperature_rules", [])]
+        progress_rules = [parse_progress_rule(rule) for rule in rules.get("progress_rules", [])]
+        with self._lock:
+            with self.db.write() as cur:
+                for table in ("registrations", "cancellations", "temperature_rules", "progress_rules"):
+                    cur.execute(f"DELETE FROM {table}")
+                cur.executemany(
                     """
-                        INSERT INTO
+                        INSERT OR REPLACE INTO
                             registrations
                         VALUES
                             (?, ?, ?, ?)
                     """,
-                    (device_mac, EventType.get_name(event), ActionType.get_name(action), delay)
+                    [
+                        (rule["device_mac"], rule["event_name"], rule["action_name"], float(rule.get("delay", 0)))
+                        for rule in rules.get("registrations", [])
+                    ]
                 )
-            except sqlite3.IntegrityError:
-                pass
+                cur.executemany(
+                    """
+                        INSERT OR IGNORE INTO
+                            cancellations
+                        VALUES
+                            (?, ?, ?)
+                    """,
+                    [
+                        (rule["device_mac"], rule["event_name"], rule["action_name"])
+                        for rule in rules.get("cancellations", [])
+                    ]
+                )
+                cur.executemany(
+                    """
+                        INSERT INTO
+                            temperature_rules
+                            (device_mac, tool, direction, threshold, hysteresis, debounce, action_name, delay, after_event)
+                        VALUES
+                            (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    [
+                        (
+                            rule["device_mac"],
+                            rule["tool"],
+                            rule["direction"],
+                            rule["threshold"],
+                            rule["hysteresis"],
+                            rule["debounce"],
+                            ActionType.get_name(rule["action"]),
+                            rule["delay"],
+                            EventType.get_name(rule["after_event"]) if rule["after_event"] is not None else None,
+                        )
+                        for rule in temperature_rules
+                    ]
+                )
+                cur.executemany(
+                    """
+                        INSERT INTO
+                            progress_rules
+                            (device_mac, progress, action_name, delay)
+                        VALUES
+                            (?, ?, ?, ?)
+                    """,
+                    [
+                        (rule["device_mac"], rule["progress"], ActionType.get_name(rule["action"]), rule["delay"])
+                        for rule in progress_rules
+                    ]
+                )
+            self.load_index()
 
 
-    def unregister(self, device_mac: str, event: EventType, action: ActionType):
-        with self.db_conn() as cur:
+    @metrics.timed("db_add_temperature_rule")
+    def add_temperature_rule(
+        self,
+        device_mac: str,
+        tool: str,
+        direction: str,
+        threshold: float,
+        action: ActionType,
+        hysteresis: float = 2,
+        debounce: float = 5,
+        delay: float = 0,
+        after_event: Optional[EventType] = None,
+    ) -> int:
+        with self.db.write() as cur:
+            cur.execute(
+                """
+                    INSERT INTO
+                        temperature_rules
+                        (device_mac, tool, direction, threshold, hysteresis, debounce, action_name, delay, after_event)
+                    VALUES
+                        (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    device_mac,
+                    tool,
+                    direction,
+                    threshold,
+                    hysteresis,
+                    debounce,
+                    ActionType.get_name(action),
+                    delay,
+                    EventType.get_name(after_event) if after_event is not None else None,
+                )
+            )
+            rule_id = cur.lastrowid
+        self.version = next(self._versions)
+        return rule_id
+
+
+    @metrics.timed("db_remove_temperature_rule")
+    def remove_temperature_rule(self, rule_id: int) -> bool:
+        with self.db.write() as cur:
             cur.execute(
                 """
                     DELETE FROM
-                        registrations
+                        temperature_rules
                     WHERE
-                        device_mac = ?
-                        AND
-                        event_name = ?
-                        AND 
-                        action_name = ?
+                        id = ?
                 """,
-                (device_mac, EventType.get_name(event), ActionType.get_name(action))
+                (rule_id, )
             )
+            removed = cur.rowcount > 0
+        self.version = next(self._versions)
+        return removed
 
 
-    def add_cancel(self, device_mac: str, event: EventType, action: ActionType):
-        with self.db_conn() as cur:
-            try:
-                cur.execute(
-                    """
-                        INSERT INTO
-                            cancellations
-                        VALUES
-                            (?, ?, ?)
-                    """,
-                    (device_mac, EventType.get_name(event), ActionType.get_name(action))
-                )
-            except sqlite3.IntegrityError:
-                pass
+    @metrics.timed("db_get_temperature_rules")
+    def get_temperature_rules(self) -> List[Dict]:
+        rules = []
+        with self.db.read() as cur:
+            for rule_id, device_mac, tool, direction, threshold, hysteresis, debounce, action_name, delay, after_event in cur.execute(
+                """
+                    SELECT * FROM
+                        temperature_rules
+                """
+            ):
+                if (action_type := ActionType.get_by_name(action_name)) is None:
+                    continue
+                rules.append({
+                    "id": rule_id,
+                    "device_mac": device_mac,
+                    "tool": tool,
+                    "direction": direction,
+                    "threshold": threshold,
+                    "action_type": action_type,
+                    "hysteresis": hysteresis,
+                    "debounce": debounce,
+                    "delay": delay,
+                    "after_event": EventType.get_by_name(after_event) if after_event is not None else None,
+                })
+        return rules
 
 
-    def remove_cancel(self, device_mac: str, event: EventType, action: ActionType):
-        with self.db_conn() as cur:
+    @metrics.timed("db_add_progress_rule")
+    def add_progress_rule(self, device_mac: str, progress: int, action: ActionType, delay: float = 0) -> int:
+        with self.db.write() as cur:
             cur.execute(
                 """
-                    DELETE FROM
-                        cancellations
-                    WHERE
-                        device_mac = ?
-                        AND
-                        event_name = ?
-                        AND 
-                        action_name = ?
+                    INSERT INTO
+                        progress_rules
+                        (device_mac, progress, action_name, delay)
+                    VALUES
+                        (?, ?, ?, ?)
                 """,
-                (device_mac, EventType.get_name(event), ActionType.get_name(action))
+                (device_mac, progress, ActionType.get_name(action), delay)
             )
+            rule_id = cur.lastrowid
+        self.version = next(self._versions)
+        return rule_id
 
 
-    def get_action(self, plugin, device: WyzeDevice, event_name: str) -> Optional[ActionType]:
-        with self.db_conn() as cur:
+    @metrics.timed("db_remove_progress_rule")
+    def remove_progress_rule(self, rule_id: int) -> bool:
+        with self.db.write() as cur:
             cur.execute(
                 """
-                    SELECT * FROM
-                        registrations
+                    DELETE FROM
+                        progress_rules
                     WHERE
-                        device_mac = ?
-                        AND
-                        event_name = ?
+                        id = ?
                 """,
-                (device.mac, event_name)
+                (rule_id, )
             )
-            result = cur.fetchone()
-            if result is not None:
-                action_name = result[2]
-                delay = result[3]
-                action_type = ActionType.get_by_name(action_name)
-                event_type = EventType.get_by_name(event_name)
-                return Action(plugin, action_type, event_type, device, delay)
-            return None
+            removed = cur.rowcount > 0
+        self.version = next(self._versions)
+        return removed
 
-        
-    def process_cancellations(self, plugin, device: WyzeDevice, event_name: str):
-        with self.db_conn() as cur:
-            for _, event_name, action_name in cur.execute(
+
+    @metrics.timed("db_get_progress_rules")
+    def get_progress_rules(self) -> List[Dict]:
+        rules = []
+        with self.db.read() as cur:
+            for rule_id, device_mac, progress, action_name, delay in cur.execute(
                 """
                     SELECT * FROM
-                        cancellations
-                    WHERE
-                        device_mac = ?
-                        AND
-                        event_name = ?
-                """,
-                (device.mac, event_name)
+                        progress_rules
+                """
             ):
-                action_type = ActionType.get_by_name(action_name)
-                matched_actions = []
-                for action in plugin.pending_actions:
-                    if action.device.mac == device.mac and action.action_type == action_type:
-                        matched_actions.append(action)
-                for action in matched_actions:
-                    plugin._logger.info(f"Event {event_name} fired. Cancelling pending action {action}...")
-                    action.cancel()
+                if (action_type := ActionType.get_by_name(action_name)) is None:
+                    continue
+                rules.append({
+                    "id": rule_id,
+                    "device_mac": device_mac,
+                    "progress": progress,
+                    "action_type": action_type,
+                    "delay": delay,
+                })
+        return rules
+
+
+    def get_subscribed_devices(self, event: EventType) -> List[str]:
+        with self._lock:
+            return list(self._index.get(event, {}))
+
+
+    def get_action(self, device: WyzeDevice, event_name: str) -> Optional[Action]:
+        event_type = EventType.get_by_name(event_name)
+        with self._lock:
+            rules = self._index.get(event_type, {}).get(device.mac, {})
+            for action_type, rule in rules.items():
+                if rule.registered:
+                    return Action(action_type, event_type, device, rule.delay)
+        return None
+
+        
+    def process_cancellations(self, plugin, device: WyzeDevice, event_name: str):
+        event_type = EventType.get_by_name(event_name)
+        with self._lock:
+            rules = self._index.get(event_type, {}).get(device.mac, {})
+            action_types = [action_type for action_type, rule in rules.items() if rule.cancel]
+        if not action_types:
+            return
+        for action in plugin.scheduler.registry.for_device(device.mac):
+            if action.action_type in action_types:
+                plugin._logger.info(f"Event {event_name} fired. Cancelling pending action {action}...")
+                plugin.scheduler.cancel(action)
             
     
+    @staticmethod
+    def empty_registrations() -> List[Dict]:
+        return [
+            {
+                "registered": False,
+                "delay": 0,
+                "cancel": False
+            }
+            for _ in EventType.discrete()
+        ]
+
+
+    @metrics.timed("db_get_registrations")
     def get_registrations(self, device_mac: str) -> Tuple[List]:
-        turn_on_registrations = []
-        turn_off_registrations = []
-        for _ in EventType:
-            turn_on_registrations.append(
-                {
-                    "registered": False,
-                    "delay": 0,
-                    "cancel": False
-                }
-            )
-            turn_off_registrations.append(
-                {
-                    "registered": False,
-                    "delay": 0,
-                    "cancel": False
-                }
-            )
-        with self.db_conn() as cur:
+        turn_on_registrations = self.empty_registrations()
+        turn_off_registrations = self.empty_registrations()
+        with self.db.read() as cur:
             for _, event_name, action_name, delay in cur.execute(
                 """
                     SELECT * FROM
@@ -364,3 +1168,145 @@ class EventHandler:
                 elif action_type == ActionType.TURN_OFF:
                     turn_off_registrations[event_type]["cancel"] = True
         return turn_on_registrations, turn_off_registrations
+
+
+    @metrics.timed("db_get_all_registrations")
+    def get_all_registrations(self) -> Dict[str, Tuple[List]]:
+        registrations = defaultdict(lambda: (self.empty_registrations(), self.empty_registrations()))
+        with self.db.read() as cur:
+            for device_mac, event_name, action_name, delay in cur.execute(
+                """
+                    SELECT * FROM
+                        registrations
+                """
+            ):
+                event_type = EventType.get_by_name(event_name)
+                action_type = ActionType.get_by_name(action_name)
+                if event_type is None or action_type is None:
+                    continue
+                # The tuple is ordered (turn on, turn off), matching ActionType
+                registration = registrations[device_mac][action_type][event_type]
+                registration["registered"] = True
+                registration["delay"] = delay
+            for device_mac, event_name, action_name in cur.execute(
+                """
+                    SELECT * FROM
+                        cancellations
+                """
+            ):
+                event_type = EventType.get_by_name(event_name)
+                action_type = ActionType.get_by_name(action_name)
+                if event_type is None or action_type is None:
+                    continue
+                registrations[device_mac][action_type][event_type]["cancel"] = True
+        return dict(registrations)
+
+
+class ActionJournal(Thread):
+    """
+    Write-behind journal of pending actions with wall clock deadlines, so
+    they survive a restart. Changes are queued and a writer thread applies
+    everything that has piled up in a single transaction, so a burst of
+    events costs one commit.
+    """
+
+    _STOP = object()
+
+    def __init__(self, db: Database, logger, linger: float = 0.05):
+        super().__init__(daemon=True, name="WyzeActionJournal")
+        self.db = db
+        self._logger = logger
+        self.linger = linger
+        self._queue: Queue = Queue()
+        self.stats = {
+            "writes": 0,
+            "commits": 0,
+        }
+
+
+    def add(self, action: Action):
+        row = (
+            action.id,
+            action.device.mac,
+            EventType.get_name(action.event_type),
+            ActionType.get_name(action.action_type),
+            time.time() + action.time_remaining,
+        )
+        self._queue.put(("add", row))
+
+
+    def remove(self, action_id: int):
+        self._queue.put(("remove", action_id))
+
+
+    @metrics.timed("db_load_journal")
+    def load(self) -> List[Tuple[int, str, EventType, ActionType, float]]:
+        entries = []
+        with self.db.read() as cur:
+            for action_id, device_mac, event_name, action_name, deadline in cur.execute(
+                """
+                    SELECT * FROM
+                        pending_actions
+                    ORDER BY
+                        deadline
+                """
+            ):
+                event_type = EventType.get_by_name(event_name)
+                action_type = ActionType.get_by_name(action_name)
+                if event_type is None or action_type is None:
+                    continue
+                entries.append((action_id, device_mac, event_type, action_type, deadline))
+        return entries
+
+
+    def stop(self, timeout: float = 5):
+        # Everything queued before the stop marker is still written
+        self._queue.put(self._STOP)
+        self.join(timeout)
+
+
+    def run(self):
+        stopped = False
+        while not stopped:
+            batch = [self._queue.get()]
+            if batch[0] is self._STOP:
+                return
+            # Let the rest of a burst arrive, then take all of it
+            time.sleep(self.linger)
+            while not self._queue.empty():
+                if (item := self._queue.get_nowait()) is self._STOP:
+                    stopped = True
+                    break
+                batch.append(item)
+            try:
+                self._write(batch)
+            except Exception:
+                self._logger.exception(f"Failed to write {len(batch)} pending action changes to the journal.")
+
+
+    @metrics.timed("db_write_journal")
+    def _write(self, batch: List[Tuple[str, object]]):
+        with self.db.write() as cur:
+            for operation, value in batch:
+                if operation == "add":
+                    cur.execute(
+                        """
+                            INSERT OR REPLACE INTO
+                                pending_actions
+                            VALUES
+                                (?, ?, ?, ?, ?)
+                        """,
+                        value
+                    )
+                else:
+                    cur.execute(
+                        """
+                            DELETE FROM
+                                pending_actions
+                            WHERE
+                                id = ?
+                        """,
+                        (value, )
+                    )
+        self.stats["writes"] += len(batch)
+        self.stats["commits"] += 1
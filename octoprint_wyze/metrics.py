@@ -0,0 +1,125 @@
+from __future__ import annotations
+
+import time
+
+from bisect import bisect_left
+from functools import wraps
+from threading import Lock
+from typing import Callable, Dict, Tuple
+
+
+# Upper bounds in seconds, chosen to span a cached dict lookup up to a slow cloud call
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # One slot per bucket plus an overflow slot for +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.errors = 0
+        self._lock = Lock()
+
+    def observe(self, value: float, error: bool = False):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            if error:
+                self.errors += 1
+
+    def record_error(self):
+        with self._lock:
+            self.errors += 1
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+            errors = self.errors
+        return {
+            "buckets": list(self.buckets),
+            "counts": counts,
+            "count": sum(counts),
+            "sum": total,
+            "errors": errors,
+        }
+
+
+class Metrics:
+    """
+    Latency histograms keyed by a fixed set of operation names, plus gauges
+    that are read when a snapshot is taken. Memory is bounded by the number
+    of names, which are all spelled out in the code.
+    """
+
+    def __init__(self):
+        self._histograms: Dict[str, Histogram] = {}
+        self._gauges: Dict[str, Callable[[], float]] = {}
+        self._lock = Lock()
+
+    def histogram(self, name: str) -> Histogram:
+        if (histogram := self._histograms.get(name)) is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(name, Histogram())
+        return histogram
+
+    def observe(self, name: str, value: float, error: bool = False):
+        self.histogram(name).observe(value, error)
+
+    def record_error(self, name: str):
+        self.histogram(name).record_error()
+
+    def gauge(self, name: str, read: Callable[[], float]):
+        with self._lock:
+            self._gauges[name] = read
+
+    def timed(self, name: str):
+        histogram = self.histogram(name)
+
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    result = function(*args, **kwargs)
+                except BaseException:
+                    histogram.observe(time.perf_counter() - start, error=True)
+                    raise
+                histogram.observe(time.perf_counter() - start)
+                return result
+            return wrapper
+        return decorator
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            histograms = dict(self._histograms)
+            gauges = dict(self._gauges)
+        return {
+            "histograms": {name: histogram.snapshot() for name, histogram in sorted(histograms.items())},
+            "gauges": {name: read() for name, read in sorted(gauges.items())},
+        }
+
+    def to_prometheus(self, prefix: str = "octoprint_wyze") -> str:
+        snapshot = self.snapshot()
+        lines = []
+        for name, histogram in snapshot["histograms"].items():
+            metric = f"{prefix}_{name}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, count in zip(histogram["buckets"], histogram["counts"]):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{le="+Inf"}} {histogram["count"]}')
+            lines.append(f"{metric}_sum {histogram['sum']}")
+            lines.append(f"{metric}_count {histogram['count']}")
+            lines.append(f"# TYPE {prefix}_{name}_errors_total counter")
+            lines.append(f"{prefix}_{name}_errors_total {histogram['errors']}")
+        for name, value in snapshot["gauges"].items():
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            lines.append(f"{prefix}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
@@ -9,29 +9,215 @@ $(function() {
     function WyzeViewModel(parameters, js_event) {
         var self = this;
 
-        self.actions = [];
-        self.events = [];
+        self.actions = ko.observableArray([]);
+        self.events = ko.observableArray([]);
         self.pendingActions = ko.observableArray([]);
         self.devices = ko.observableArray([]);
+        self.connectionStatus = ko.observable({
+            "state": "disconnected",
+            "email": null,
+            "error": null,
+        });
+
+        self.connectionText = ko.pureComputed(function() {
+            var status = self.connectionStatus();
+            if (status.state === "connected") {
+                return "Connected to Wyze as " + status.email + ".";
+            }
+            else if (status.state === "connecting") {
+                return "Connecting to Wyze as " + status.email + "...";
+            }
+            else if (status.state === "failed") {
+                return "Could not connect to Wyze as " + status.email + ": " + status.error;
+            }
+            return "Not connected to Wyze. Add your credentials in the plugin settings.";
+        });
 
         OctoPrint.simpleApiCommand(
             "wyze",
-            "get_enums",
+            "get_connection_status",
         ).done(function(response) {
-            self.events = response.events;
-            self.actions = response.actions;
+            self.connectionStatus(response);
         });
 
+        // The last get_enums and get_devices payloads are kept in localStorage with
+        // their ETag, shown straight away and then revalidated with If-None-Match
+        function readCache(name) {
+            try {
+                return JSON.parse(window.localStorage.getItem("wyze." + name));
+            }
+            catch (e) {
+                return null;
+            }
+        }
+
+        function writeCache(name, etag, payload) {
+            if (!etag) {
+                return;
+            }
+            try {
+                window.localStorage.setItem("wyze." + name, JSON.stringify({"etag": etag, "payload": payload}));
+            }
+            catch (e) {
+                // Storage is full or disabled, so the next load fetches everything again
+            }
+        }
+
+        function cachedApiCommand(name, command, render, showCached) {
+            var cached = readCache(name);
+            var headers = {};
+            if (cached !== null) {
+                if (showCached) {
+                    render(cached.payload);
+                }
+                headers["If-None-Match"] = cached.etag;
+            }
+            return OctoPrint.simpleApiCommand(
+                "wyze",
+                command,
+                {},
+                {
+                    "headers": headers,
+                }
+            ).done(function(response, status, xhr) {
+                if (xhr.status === 304) {
+                    return;
+                }
+                render(response);
+                writeCache(name, xhr.getResponseHeader("ETag"), response);
+            });
+        }
+
+        cachedApiCommand("enums", "get_enums", function(response) {
+            self.events(response.events);
+            self.actions(response.actions);
+        }, true);
+
+        // Ticks once a second so pending actions can count down locally
+        self.now = ko.observable(Date.now());
+
+        function PendingAction(data) {
+            var this_action = this;
+
+            this_action.id = data.id;
+            this_action.expiresAt = Date.now() + data.time_remaining * 1000;
+
+            this_action.text = ko.pureComputed(function() {
+                var remaining = Math.max(0, Math.round((this_action.expiresAt - self.now()) / 1000));
+                return data.event_name + ": " + data.device_name + " will " + data.action_name + " in " + remaining + " seconds.";
+            });
+        }
+
+        function removePendingAction(id) {
+            self.pendingActions.remove(function(action) {
+                return action.id === id;
+            });
+        }
+
+        // Full resync, used on load and whenever the socket reconnects
         function getPendingActions() {
             OctoPrint.simpleApiCommand(
                 "wyze",
                 "get_pending_actions",
+                {
+                    "detailed": true,
+                }
             ).done(function(response) {
-                self.pendingActions(response);
+                self.pendingActions($.map(response, function(item) {
+                    return new PendingAction(item);
+                }));
+            });
+        }
+
+        getPendingActions();
+
+        var countdownInterval = window.setInterval(function() {
+            if (self.pendingActions().length > 0) {
+                self.now(Date.now());
+            }
+        }, 1000);
+
+        self.onDataUpdaterPluginMessage = function(plugin, data) {
+            if (plugin !== "wyze") {
+                return;
+            }
+            if (data.type === "connection") {
+                self.connectionStatus(data.status);
+                if (data.status.state === "connected") {
+                    loadDevices();
+                }
+            }
+            else if (data.type === "device_state") {
+                $.each(self.devices(), function(index, device) {
+                    if (device.mac in data.changes) {
+                        device.state(data.changes[device.mac]);
+                    }
+                });
+            }
+            else if (data.type === "device_health") {
+                $.each(self.devices(), function(index, device) {
+                    if (device.mac in data.changes) {
+                        device.health(data.changes[device.mac]);
+                    }
+                });
+            }
+            else if (data.type === "pending_action") {
+                removePendingAction(data.action.id);
+                if (data.change === "added") {
+                    self.pendingActions.push(new PendingAction(data.action));
+                }
+            }
+            else if (data.type === "job" && data.job.status === "failed") {
+                new PNotify({
+                    title: "Wyze",
+                    text: "Could not " + data.job.command.replace("_", " ") + " " + data.job.device_mac + ": " + data.job.error,
+                    type: "error",
+                });
+            }
+            else if (data.type === "job" && data.job.status === "deferred") {
+                new PNotify({
+                    title: "Wyze",
+                    text: data.job.device_mac + " is offline, it will " + data.job.command.replace("_", " ") + " once it is back.",
+                    type: "info",
+                });
+            }
+        };
+
+        self.onDataUpdaterReconnect = function() {
+            getPendingActions();
+        };
+
+        // Registration edits are collected and sent as one batch once the user pauses
+        var queuedChanges = {};
+        var flushTimeout = null;
+
+        function queueChange(change) {
+            var kind = (change.operation === "add_cancel" || change.operation === "remove_cancel") ? "cancel" : "registration";
+            // A later edit of the same checkbox replaces the earlier one
+            queuedChanges[[change.device_mac, change.event_name, change.action_name, kind].join("|")] = change;
+            window.clearTimeout(flushTimeout);
+            flushTimeout = window.setTimeout(flushChanges, 500);
+        }
+
+        function flushChanges() {
+            window.clearTimeout(flushTimeout);
+            var changes = $.map(queuedChanges, function(change) {
+                return change;
             });
+            queuedChanges = {};
+            if (changes.length === 0) {
+                return $.Deferred().resolve().promise();
+            }
+            return OctoPrint.simpleApiCommand(
+                "wyze",
+                "apply_registrations",
+                {
+                    "changes": changes,
+                }
+            );
         }
 
-        var getPendingActionsInterval = window.setInterval(getPendingActions, 500);
+        $(window).on("beforeunload", flushChanges);
 
         function Device(data) {
             var this_device = this;
@@ -39,6 +225,22 @@ $(function() {
             this_device.mac = data.device_mac;
             this_device.name = data.device_name;
             this_device.type = data.device_type;
+            this_device.state = ko.observable(data.state);
+            this_device.health = ko.observable(data.health);
+
+            this_device.stateText = ko.pureComputed(function() {
+                var state = this_device.state();
+                if (this_device.health() === "unreachable") {
+                    return "Unreachable";
+                }
+                if (!state || state.is_online === null) {
+                    return "";
+                }
+                if (!state.is_online) {
+                    return "Offline";
+                }
+                return state.is_on ? "On" : "Off";
+            });
 
             this_device.turnOnDevice = function() {
                 OctoPrint.simpleApiCommand(
@@ -61,56 +263,40 @@ $(function() {
             };
 
             this_device.registerDevice = function(event_index, action_name, delay) {
-                event_name = self.events[event_index];
-                OctoPrint.simpleApiCommand(
-                    "wyze",
-                    "register",
-                    {
-                        "device_mac": this_device.mac,
-                        "event_name": event_name,
-                        "action_name": action_name,
-                        "delay": delay,
-                    }
-                )
+                queueChange({
+                    "operation": "register",
+                    "device_mac": this_device.mac,
+                    "event_name": self.events()[event_index],
+                    "action_name": action_name,
+                    "delay": delay,
+                });
             }
 
             this_device.unregisterDevice = function(event_index, action_name) {
-                event_name = self.events[event_index];
-                OctoPrint.simpleApiCommand(
-                    "wyze",
-                    "unregister",
-                    {
-                        "device_mac": this_device.mac,
-                        "event_name": event_name,
-                        "action_name": action_name,
-                    }
-                )
+                queueChange({
+                    "operation": "unregister",
+                    "device_mac": this_device.mac,
+                    "event_name": self.events()[event_index],
+                    "action_name": action_name,
+                });
             }
 
             this_device.addCancel = function(event_index, action_name) {
-                event_name = self.events[event_index];
-                OctoPrint.simpleApiCommand(
-                    "wyze",
-                    "add_cancel",
-                    {
-                        "device_mac": this_device.mac,
-                        "event_name": event_name,
-                        "action_name": action_name,
-                    }
-                )
+                queueChange({
+                    "operation": "add_cancel",
+                    "device_mac": this_device.mac,
+                    "event_name": self.events()[event_index],
+                    "action_name": action_name,
+                });
             }
 
             this_device.removeCancel = function(event_index, action_name) {
-                event_name = self.events[event_index];
-                OctoPrint.simpleApiCommand(
-                    "wyze",
-                    "remove_cancel",
-                    {
-                        "device_mac": this_device.mac,
-                        "event_name": event_name,
-                        "action_name": action_name,
-                    }
-                )
+                queueChange({
+                    "operation": "remove_cancel",
+                    "device_mac": this_device.mac,
+                    "event_name": self.events()[event_index],
+                    "action_name": action_name,
+                });
             }
 
             this_device.turnOnCancelClicked = function(data, js_event) {
@@ -169,36 +355,231 @@ $(function() {
                 return true;
             }
 
-            this_device.turn_on_registrations = $.map(data.turn_on_registrations, function(item, event_index) {
+            function makeRegistration(item, event_index, action_name) {
                 var registration = {
                     eventIndex: event_index,
                     registered: ko.observable(item.registered),
                     delay: ko.observable(item.delay),
                     cancel: ko.observable(item.cancel),
                 };
+                // Editing the delay of a registered handler re-registers it with the new delay
+                registration.delay.subscribe(function(delay) {
+                    if (registration.registered() && delay !== "" && !isNaN(delay)) {
+                        this_device.registerDevice(event_index, action_name, Number(delay));
+                    }
+                });
                 return registration;
+            }
+
+            this_device.turn_on_registrations = $.map(data.turn_on_registrations, function(item, event_index) {
+                return makeRegistration(item, event_index, "TurnOn");
             });
 
             this_device.turn_off_registrations = $.map(data.turn_off_registrations, function(item, event_index) {
-                var registration = {
-                    eventIndex: event_index,
-                    registered: ko.observable(item.registered),
-                    delay: ko.observable(item.delay),
-                    cancel: ko.observable(item.cancel),
-                };
-                return registration;
+                return makeRegistration(item, event_index, "TurnOff");
             });
         }
 
-        OctoPrint.simpleApiCommand(
-            "wyze",
-            "get_devices",
-        ).done(function(response) {
+        function setDevices(response) {
             var devices = $.map(response, function(item) {
                 return new Device(item);
             });
             self.devices(devices);
-        });
+        }
+
+        // Only the first load shows the cached list, later ones would undo unsent edits
+        function loadDevices(showCached) {
+            cachedApiCommand("devices", "get_devices", setDevices, showCached);
+        }
+
+        loadDevices(true);
+
+        self.refreshDevices = function() {
+            OctoPrint.simpleApiCommand(
+                "wyze",
+                "refresh_devices",
+            ).done(function(response, status, xhr) {
+                setDevices(response);
+                writeCache("devices", xhr.getResponseHeader("ETag"), response);
+            });
+        };
+
+        self.exportRules = function() {
+            flushChanges().always(function() {
+                OctoPrint.simpleApiCommand(
+                    "wyze",
+                    "export_rules",
+                ).done(function(response) {
+                    var blob = new Blob([JSON.stringify(response, null, 2)], {type: "application/json"});
+                    var link = document.createElement("a");
+                    link.href = URL.createObjectURL(blob);
+                    link.download = "wyze-rules.json";
+                    link.click();
+                    URL.revokeObjectURL(link.href);
+                });
+            });
+        };
+
+        self.chooseRulesFile = function() {
+            $("#wyze-import-rules").click();
+        };
+
+        self.importRules = function(data, js_event) {
+            var file = js_event.target.files[0];
+            js_event.target.value = "";
+            if (!file) {
+                return;
+            }
+            var reader = new FileReader();
+            reader.onload = function() {
+                var rules;
+                try {
+                    rules = JSON.parse(reader.result);
+                }
+                catch (error) {
+                    new PNotify({
+                        title: "Wyze",
+                        text: "Could not read " + file.name + ": " + error,
+                        type: "error",
+                    });
+                    return;
+                }
+                OctoPrint.simpleApiCommand(
+                    "wyze",
+                    "import_rules",
+                    {
+                        "rules": rules,
+                    }
+                ).done(function() {
+                    loadDevices();
+                    getTemperatureRules();
+                    getProgressRules();
+                }).fail(function(response) {
+                    new PNotify({
+                        title: "Wyze",
+                        text: "Could not import " + file.name + ": " + response.statusText,
+                        type: "error",
+                    });
+                });
+            };
+            reader.readAsText(file);
+        };
+
+        self.temperatureRules = ko.observableArray([]);
+        self.tools = ["B", "T0", "T1", "C"];
+        self.directions = ["above", "below"];
+        self.newTemperatureRule = {
+            device_mac: ko.observable(),
+            tool: ko.observable("B"),
+            direction: ko.observable("above"),
+            threshold: ko.observable(),
+            action_name: ko.observable("TurnOn"),
+            delay: ko.observable(0),
+            after_event: ko.observable(),
+        };
+
+        self.deviceName = function(mac) {
+            var device = ko.utils.arrayFirst(self.devices(), function(device) {
+                return device.mac === mac;
+            });
+            return device ? device.name : mac;
+        };
+
+        self.temperatureRuleText = function(rule) {
+            var text = self.deviceName(rule.device_mac) + " will " + (rule.action_name === "TurnOn" ? "turn on" : "turn off");
+            if (rule.delay > 0) {
+                text += " " + rule.delay + " minutes after";
+            }
+            else {
+                text += " when";
+            }
+            text += " " + rule.tool + " goes " + rule.direction + " " + rule.threshold + "°C";
+            if (rule.after_event) {
+                text += " following " + rule.after_event;
+            }
+            return text + ".";
+        };
+
+        function getTemperatureRules() {
+            OctoPrint.simpleApiCommand(
+                "wyze",
+                "get_temperature_rules",
+            ).done(self.temperatureRules);
+        }
+
+        getTemperatureRules();
+
+        self.addTemperatureRule = function() {
+            var rule = ko.toJS(self.newTemperatureRule);
+            if (!rule.device_mac || rule.threshold === undefined || rule.threshold === "") {
+                return;
+            }
+            OctoPrint.simpleApiCommand(
+                "wyze",
+                "add_temperature_rule",
+                rule
+            ).done(self.temperatureRules);
+        };
+
+        self.removeTemperatureRule = function(rule) {
+            OctoPrint.simpleApiCommand(
+                "wyze",
+                "remove_temperature_rule",
+                {
+                    "rule_id": rule.id,
+                }
+            ).done(self.temperatureRules);
+        };
+
+        self.progressRules = ko.observableArray([]);
+        self.newProgressRule = {
+            device_mac: ko.observable(),
+            progress: ko.observable(),
+            action_name: ko.observable("TurnOn"),
+            delay: ko.observable(0),
+        };
+
+        self.progressRuleText = function(rule) {
+            var text = self.deviceName(rule.device_mac) + " will " + (rule.action_name === "TurnOn" ? "turn on" : "turn off");
+            if (rule.delay > 0) {
+                text += " " + rule.delay + " minutes after";
+            }
+            else {
+                text += " when";
+            }
+            return text + " the print reaches " + rule.progress + "%.";
+        };
+
+        function getProgressRules() {
+            OctoPrint.simpleApiCommand(
+                "wyze",
+                "get_progress_rules",
+            ).done(self.progressRules);
+        }
+
+        getProgressRules();
+
+        self.addProgressRule = function() {
+            var rule = ko.toJS(self.newProgressRule);
+            if (!rule.device_mac || rule.progress === undefined || rule.progress === "") {
+                return;
+            }
+            OctoPrint.simpleApiCommand(
+                "wyze",
+                "add_progress_rule",
+                rule
+            ).done(self.progressRules);
+        };
+
+        self.removeProgressRule = function(rule) {
+            OctoPrint.simpleApiCommand(
+                "wyze",
+                "remove_progress_rule",
+                {
+                    "rule_id": rule.id,
+                }
+            ).done(self.progressRules);
+        };
 
         // assign the injected parameters, e.g.:
         // self.loginStateViewModel = parameters[0];
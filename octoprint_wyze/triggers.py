@@ -0,0 +1,229 @@
+from __future__ import annotations
+
+import time
+
+from bisect import bisect_right
+from threading import Lock
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional
+
+from .events import TEMPERATURE_ABOVE, TEMPERATURE_BELOW, ActionType, EventType
+
+
+class TemperatureRule:
+    """
+    Fires once when a tool's actual temperature has stayed past the threshold
+    for `debounce` seconds. It re-arms once the temperature has come back by
+    `hysteresis` degrees, or, for rules with an `after_event`, only when that
+    event fires again.
+    """
+
+    ABOVE = TEMPERATURE_ABOVE
+    BELOW = TEMPERATURE_BELOW
+
+    event_type = EventType.TEMPERATURE
+
+    __slots__ = (
+        "id", "device_mac", "tool", "direction", "threshold", "hysteresis", "debounce",
+        "action_type", "delay", "after_event", "armed", "crossed_at",
+    )
+
+    def __init__(
+        self,
+        id: int,
+        device_mac: str,
+        tool: str,
+        direction: str,
+        threshold: float,
+        action_type: ActionType,
+        hysteresis: float = 2,
+        debounce: float = 5,
+        delay: float = 0,
+        after_event: Optional[EventType] = None,
+    ):
+        self.id = id
+        self.device_mac = device_mac
+        self.tool = tool
+        self.direction = direction
+        self.threshold = threshold
+        self.action_type = action_type
+        self.hysteresis = hysteresis
+        self.debounce = debounce
+        self.delay = delay
+        self.after_event = after_event
+        self.armed = after_event is None
+        self.crossed_at: Optional[float] = None
+
+
+    def definition(self) -> tuple:
+        return (
+            self.id, self.device_mac, self.tool, self.direction, self.threshold, self.hysteresis,
+            self.debounce, self.action_type, self.delay, self.after_event,
+        )
+
+
+    def evaluate(self, temperature: float, now: float) -> bool:
+        if self.direction == self.ABOVE:
+            crossed = temperature > self.threshold
+            reset = temperature <= self.threshold - self.hysteresis
+        else:
+            crossed = temperature < self.threshold
+            reset = temperature >= self.threshold + self.hysteresis
+        if not self.armed:
+            if reset and self.after_event is None:
+                self.armed = True
+            return False
+        if not crossed:
+            self.crossed_at = None
+            return False
+        if self.crossed_at is None:
+            self.crossed_at = now
+        if now - self.crossed_at < self.debounce:
+            return False
+        self.armed = False
+        self.crossed_at = None
+        return True
+
+
+    def to_dict(self) -> Dict:
+        return {
+            "id": self.id,
+            "device_mac": self.device_mac,
+            "tool": self.tool,
+            "direction": self.direction,
+            "threshold": self.threshold,
+            "hysteresis": self.hysteresis,
+            "debounce": self.debounce,
+            "action_name": ActionType.get_name(self.action_type),
+            "delay": self.delay,
+            "after_event": EventType.get_name(self.after_event) if self.after_event is not None else None,
+            "armed": self.armed,
+        }
+
+
+    def __str__(self):
+        return f"{self.tool} {self.direction} {self.threshold:g}°C"
+
+
+class TemperatureMonitor:
+    """
+    Evaluates temperature rules against the samples OctoPrint's comm thread
+    reports. Each sample only touches the rules for the tools it contains, and
+    triggered rules are handed to `on_trigger`, which must not block.
+    """
+
+    def __init__(self, on_trigger: Callable[[TemperatureRule], None]):
+        self._on_trigger = on_trigger
+        # Replaced whole on every change so the comm thread never needs the lock
+        self._rules_by_tool: Dict[str, List[TemperatureRule]] = {}
+        self.arm_events: FrozenSet[EventType] = frozenset()
+        self._lock = Lock()
+
+
+    def load(self, rules: Iterable[TemperatureRule]):
+        with self._lock:
+            # Keep the armed state of rules that survive the reload unchanged.
+            # Ids alone are not enough: importing rules reuses them.
+            current = {rule.definition(): rule for rules in self._rules_by_tool.values() for rule in rules}
+            rules_by_tool = {}
+            for rule in rules:
+                rule = current.get(rule.definition(), rule)
+                rules_by_tool.setdefault(rule.tool, []).append(rule)
+            self._rules_by_tool = rules_by_tool
+            self.arm_events = frozenset(
+                rule.after_event for rules in rules_by_tool.values() for rule in rules if rule.after_event is not None
+            )
+
+
+    def rules(self) -> List[TemperatureRule]:
+        return [rule for rules in self._rules_by_tool.values() for rule in rules]
+
+
+    def arm(self, event: EventType):
+        for rules in self._rules_by_tool.values():
+            for rule in rules:
+                if rule.after_event == event:
+                    rule.armed = True
+                    rule.crossed_at = None
+
+
+    def process(self, temperatures: Dict[str, tuple]):
+        now = time.monotonic()
+        for tool, rules in self._rules_by_tool.items():
+            if (sample := temperatures.get(tool)) is None or sample[0] is None:
+                continue
+            for rule in rules:
+                if rule.evaluate(sample[0], now):
+                    self._on_trigger(rule)
+
+
+class ProgressRule:
+    __slots__ = ("id", "device_mac", "progress", "action_type", "delay")
+
+    event_type = EventType.PROGRESS
+
+    def __init__(self, id: int, device_mac: str, progress: int, action_type: ActionType, delay: float = 0):
+        self.id = id
+        self.device_mac = device_mac
+        self.progress = progress
+        self.action_type = action_type
+        self.delay = delay
+
+
+    def to_dict(self) -> Dict:
+        return {
+            "id": self.id,
+            "device_mac": self.device_mac,
+            "progress": self.progress,
+            "action_name": ActionType.get_name(self.action_type),
+            "delay": self.delay,
+        }
+
+
+    def __str__(self):
+        return f"{self.progress}% progress"
+
+
+class ProgressMonitor:
+    """
+    Keeps progress rules sorted by threshold with a pointer to the next one
+    due, so each progress callback only compares against that rule. The
+    pointer goes back to the start when a print starts.
+    """
+
+    def __init__(self, on_trigger: Callable[[ProgressRule], None]):
+        self._on_trigger = on_trigger
+        self._rules: List[ProgressRule] = []
+        self._thresholds: List[int] = []
+        self._next = 0
+        self._progress = -1
+        self._lock = Lock()
+
+
+    def load(self, rules: Iterable[ProgressRule]):
+        rules = sorted(rules, key=lambda rule: (rule.progress, rule.id))
+        with self._lock:
+            self._rules = rules
+            self._thresholds = [rule.progress for rule in rules]
+            # Rules added mid-print below the current progress wait for the next print
+            self._next = bisect_right(self._thresholds, self._progress)
+
+
+    def rules(self) -> List[ProgressRule]:
+        return list(self._rules)
+
+
+    def reset(self):
+        with self._lock:
+            self._next = 0
+            self._progress = -1
+
+
+    def process(self, progress: int):
+        with self._lock:
+            self._progress = progress
+            due: List[ProgressRule] = []
+            while self._next < len(self._rules) and self._thresholds[self._next] <= progress:
+                due.append(self._rules[self._next])
+                self._next += 1
+        for rule in due:
+            self._on_trigger(rule)
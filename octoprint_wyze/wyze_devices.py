@@ -1,42 +1,363 @@
-from typing import List, Dict
-from wyze_sdk import Client
-from wyze_sdk.errors import WyzeClientConfigurationError, WyzeApiError
+from __future__ import annotations
+
+import hashlib
+import itertools
+import json
+import logging
+import os
+import time
+
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock, Thread, Timer
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from .api import ApiClient, CircuitBreaker
+from .metrics import metrics
+
+
+# Error code the Wyze API returns once an access token has expired
+ACCESS_TOKEN_ERROR_CODE = "2001"
+
+# Shared by every Wyze and DeviceHealth instance, so a reconnect never reuses a version
+_versions = itertools.count(1)
+
+# Breaker for the account-wide device list, kept apart from the per-device ones
+INVENTORY_CIRCUIT = "devices_list"
+
+# Seconds a single HTTP request to the Wyze cloud may wait on its socket
+_socket_timeout = 10
+
+
+# wyze_sdk pulls in its whole client tree, which adds noticeably to OctoPrint's
+# startup on a Pi, so it is only imported once a connection is actually made
+def create_client(socket_timeout: Optional[float] = None, **kwargs):
+    from wyze_sdk import Client
+    install_socket_timeout(socket_timeout)
+    return Client(**kwargs)
+
+
+def install_socket_timeout(timeout: Optional[float] = None):
+    """
+    wyze_sdk opens a new requests session for every call and sends without a
+    timeout, so a stalled connection would hold its thread indefinitely. Every
+    session it opens gets an adapter that fills in a timeout instead.
+    """
+    global _socket_timeout
+    if timeout is not None:
+        _socket_timeout = timeout
+    from requests.adapters import HTTPAdapter
+    from wyze_sdk.service.base import BaseServiceClient
+    if getattr(BaseServiceClient._do_request, "installs_socket_timeout", False):
+        return
+
+    class TimeoutAdapter(HTTPAdapter):
+        def send(self, request, timeout=None, **kwargs):
+            return super().send(request, timeout=_socket_timeout if timeout is None else timeout, **kwargs)
+
+    do_request = BaseServiceClient._do_request
+
+    def _do_request(self, session, request):
+        adapter = TimeoutAdapter()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return do_request(self, session, request)
+
+    _do_request.installs_socket_timeout = True
+    BaseServiceClient._do_request = _do_request
+
+
+def is_access_token_error(error: Exception) -> bool:
+    from wyze_sdk.errors import WyzeApiError
+    if not isinstance(error, WyzeApiError):
+        return False
+    # wyze_sdk attaches the decoded response body, not the response object
+    data = error.response if isinstance(error.response, dict) else {}
+    return str(data.get("code")) == ACCESS_TOKEN_ERROR_CODE or data.get("msg") == "AccessTokenError"
+
+
+class TokenStore:
+    def __init__(self, path: str, fernet):
+        self.path = path
+        self.fernet = fernet
+
+    def load(self, email: str) -> Optional[Dict]:
+        try:
+            with open(self.path, "rb") as f:
+                tokens = json.loads(self.fernet.decrypt(f.read()).decode())
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # Unreadable or encrypted with an older key, so start over with a full login
+            return None
+        if tokens.get("email") != email:
+            return None
+        return tokens
+
+    def save(self, email: str, access_token: str, refresh_token: str):
+        tokens = {
+            "email": email,
+            "access_token": access_token,
+            "refresh_token": refresh_token,
+        }
+        encrypted = self.fernet.encrypt(json.dumps(tokens).encode())
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(encrypted)
+        os.replace(temp_path, self.path)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class CredentialStore:
+    """
+    Keeps the decrypted Wyze secrets in memory so that settings loads and saves
+    only do Fernet work when a secret actually changes. Secrets are passed and
+    returned as (password, api_key, key_id) tuples.
+    """
+
+    FIELDS = ("wyze_password", "wyze_api_key", "wyze_key_id")
+
+    def __init__(self):
+        self.stats = {"hits": 0, "decrypts": 0, "encrypts": 0}
+        self.fernet = None
+        self._lock = Lock()
+        self._key = None
+        self._encrypted = None
+        self._secrets = None
+        self._fingerprint = None
+
+    @staticmethod
+    def fingerprint(secrets: Tuple) -> str:
+        digest = hashlib.sha256()
+        for secret in secrets:
+            digest.update(secret.encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    @property
+    def secrets(self) -> Optional[Tuple]:
+        return self._secrets
+
+    def decrypt(self, key, encrypted: Tuple) -> Tuple[Tuple, bool]:
+        """
+        Returns the secrets for the stored key and ciphertexts, and whether they
+        differ from the ones already held.
+        """
+        with self._lock:
+            if key == self._key and encrypted == self._encrypted:
+                self.stats["hits"] += 1
+                return self._secrets, False
+            from cryptography.fernet import Fernet
+            fernet = Fernet(key)
+            secrets = tuple(fernet.decrypt(value).decode() for value in encrypted)
+            self.stats["decrypts"] += 1
+            fingerprint = self.fingerprint(secrets)
+            changed = fingerprint != self._fingerprint
+            self._remember(fernet, key, encrypted, secrets, fingerprint)
+            return secrets, changed
+
+    def encrypt(self, secrets: Tuple) -> Tuple[bytes, Tuple, bool]:
+        """
+        Returns a key and ciphertexts for the secrets, and whether they changed.
+        Unchanged secrets get back the key and ciphertexts already stored.
+        """
+        fingerprint = self.fingerprint(secrets)
+        with self._lock:
+            if fingerprint == self._fingerprint:
+                self.stats["hits"] += 1
+                return self._key, self._encrypted, False
+            from cryptography.fernet import Fernet
+            key = Fernet.generate_key()
+            fernet = Fernet(key)
+            encrypted = tuple(fernet.encrypt(secret.encode()) for secret in secrets)
+            self.stats["encrypts"] += 1
+            self._remember(fernet, key, encrypted, secrets, fingerprint)
+            return key, encrypted, True
+
+    def _remember(self, fernet, key, encrypted: Tuple, secrets: Tuple, fingerprint: str):
+        self.fernet = fernet
+        self._key = key
+        self._encrypted = encrypted
+        self._secrets = secrets
+        self._fingerprint = fingerprint
 
 
 class Wyze:
-    def __init__(self, email, password, api_key, key_id):
+    def __init__(
+        self,
+        email,
+        password,
+        api_key,
+        key_id,
+        ttl: float = 300,
+        active_interval: float = 15,
+        is_active: Optional[Callable[[], bool]] = None,
+        on_state_change: Optional[Callable[[Dict[str, Optional[Dict]]], None]] = None,
+        logger=None,
+        token_store: Optional[TokenStore] = None,
+        api: Optional[ApiClient] = None,
+    ):
+        self._logger = logger or logging.getLogger(__name__)
+        self.api = api or ApiClient(logger=self._logger)
+        self.email = email
+        self.password = password
+        self.api_key = api_key
+        self.key_id = key_id
+        # Devices are polled every ttl seconds when idle and every
+        # active_interval seconds while is_active() says something is going on
+        self.ttl = ttl
+        self.active_interval = active_interval
+        self.is_active = is_active or (lambda: False)
+        self._on_state_change = on_state_change
+        self.token_store = token_store
+        self.devices = {}
+        self.states: Dict[str, Dict] = {}
+        # Bumped whenever the inventory or a device state changes
+        self.version = next(_versions)
+        self._inventory: List[Tuple[str, str, str]] = []
+        # Set once a device list has been fetched, so an empty inventory can be told from a failed one
+        self.inventory_loaded = False
+        self._renew_lock = Lock()
+        if not self.resume_session():
+            self.login()
+        self.refresh_devices()
+        self._refresher = DeviceRefresher(self)
+        self._refresher.start()
+
+    def resume_session(self) -> bool:
+        if self.token_store is None or (tokens := self.token_store.load(self.email)) is None:
+            return False
+        self._logger.info(f"Resuming the saved Wyze session for {self.email}...")
+        self.client = create_client(
+            socket_timeout=self.api.socket_timeout,
+            token=tokens["access_token"],
+            refresh_token=tokens["refresh_token"],
+        )
+        return True
+
+    def login(self):
+        from wyze_sdk.errors import WyzeApiError, WyzeClientConfigurationError
         try:
-            self.client = Client(
-                email=email,
-                password=password,
-                api_key=api_key,
-                key_id=key_id
+            self.client = self.api.call(
+                create_client,
+                socket_timeout=self.api.socket_timeout,
+                email=self.email,
+                password=self.password,
+                api_key=self.api_key,
+                key_id=self.key_id,
             )
         except (WyzeClientConfigurationError, WyzeApiError):
             self.client = None
-        self.refresh_devices()
+            return
+        self.save_session()
 
-    def refresh_devices(self):
-        self.devices = {}
-        if self.client is None:
+    def renew_session(self):
+        try:
+            self.api.call(self.client.refresh_token)
+        except Exception:
+            self._logger.info("Could not refresh the Wyze access token, logging in again...")
+            self.login()
+        else:
+            self.save_session()
+
+    def renew_devices(self) -> bool:
+        # Device objects copy the access token when they are made, so they are rebuilt too
+        with self._renew_lock:
+            self.renew_session()
+            return self.refresh_devices()
+
+    def save_session(self):
+        if self.token_store is None or self.client is None:
             return
-        for device in self.client.devices_list():
-            if (wyze_device := WyzeDeviceFactory(self.client, device)) is not None:
-                self.devices[device.mac] = wyze_device
+        try:
+            self.token_store.save(self.email, self.client._token, self.client._refresh_token)
+        except Exception:
+            self._logger.exception("Failed to save the Wyze session.")
+
+    @metrics.timed("wyze_refresh_devices")
+    def refresh_devices(self) -> bool:
+        if self.client is None:
+            return False
+        # Build the new inventory on the side and swap it in whole, so readers
+        # always see a complete snapshot and a failure keeps the last good one
+        devices = {}
+        try:
+            try:
+                device_list = self.api.call(self.client.devices_list, circuit=INVENTORY_CIRCUIT)
+            except Exception as e:
+                if not is_access_token_error(e):
+                    raise
+                self.renew_session()
+                if self.client is None:
+                    return False
+                device_list = self.api.call(self.client.devices_list, circuit=INVENTORY_CIRCUIT)
+            for device in device_list:
+                if (wyze_device := WyzeDeviceFactory(self.client, device, self.api)) is not None:
+                    devices[device.mac] = wyze_device
+        except Exception:
+            self._logger.exception("Failed to refresh Wyze devices, keeping the previous inventory.")
+            metrics.record_error("wyze_refresh_devices")
+            return False
+        self.devices = devices
+        self.inventory_loaded = True
+        inventory = [(device_mac, device.name, device.type) for device_mac, device in devices.items()]
+        if inventory != self._inventory:
+            self._inventory = inventory
+            self.version = next(_versions)
+        self._update_states(devices)
+        return True
+
+    def _update_states(self, devices: Dict[str, WyzeDevice]):
+        states = {device_mac: device.state() for device_mac, device in devices.items()}
+        changes = {
+            device_mac: state
+            for device_mac, state in states.items()
+            if self.states.get(device_mac) != state
+        }
+        for device_mac in self.states.keys() - states.keys():
+            changes[device_mac] = None
+        self.states = states
+        if changes:
+            self.version = next(_versions)
+        if changes and self._on_state_change is not None:
+            try:
+                self._on_state_change(changes)
+            except Exception:
+                self._logger.exception("Failed to report Wyze device state changes.")
+
+    def wake(self):
+        self._refresher.wake()
+
+    def stop(self):
+        self._refresher.stop()
 
     def get_device_by_mac(self, device_mac):
         return self.devices[device_mac]
 
-    def get_devices(self, event_handler) -> List[Dict]:
-        self.refresh_devices()
+    def get_devices(self, event_handler, health: Optional[DeviceHealth] = None) -> List[Dict]:
         devices = []
+        registrations = event_handler.get_all_registrations()
+        # The statuses as of the last check(), which is what health.version tracks.
+        # A live status could change (say, a breaker going half-open) behind a cached ETag.
+        statuses = health.snapshot() if health is not None else {}
         for device_mac, device in self.devices.items():
-            turn_on_registrations, turn_off_registrations = event_handler.get_registrations(device_mac)
+            if device_mac in registrations:
+                turn_on_registrations, turn_off_registrations = registrations[device_mac]
+            else:
+                turn_on_registrations = event_handler.empty_registrations()
+                turn_off_registrations = event_handler.empty_registrations()
             devices.append(
                 {
                     "device_mac": device_mac,
                     "device_name": device.name,
                     "device_type": device.type,
+                    "state": self.states.get(device_mac),
+                    "health": statuses.get(device_mac, DeviceHealth.HEALTHY) if health is not None else None,
                     "turn_on_registrations": turn_on_registrations,
                     "turn_off_registrations": turn_off_registrations,
                 }
@@ -44,24 +365,567 @@ class Wyze:
         return devices
 
 
+class WyzeConnection:
+    DISCONNECTED = "disconnected"
+    CONNECTING = "connecting"
+    CONNECTED = "connected"
+    FAILED = "failed"
+
+    def __init__(
+        self,
+        on_change: Optional[Callable[[Dict], None]] = None,
+        logger=None,
+        retry_delay: float = 15,
+        max_retry_delay: float = 300,
+        **options,
+    ):
+        self._logger = logger or logging.getLogger(__name__)
+        # Passed through to every Wyze session
+        self.options = options
+        self._on_change = on_change
+        # Attempts that failed for a transient reason are retried with a doubling delay
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._retries = 0
+        self._retry_timer: Optional[Timer] = None
+        self._lock = Lock()
+        self._credentials = None
+        # Bumped on every new connection attempt so stale attempts are discarded
+        self._generation = 0
+        self.state = self.DISCONNECTED
+        self.error = None
+        self.wyze: Optional[Wyze] = None
+
+    def connect(self, email, password, api_key, key_id, token_store: Optional[TokenStore] = None):
+        credentials = (email, password, api_key, key_id)
+        with self._lock:
+            if credentials == self._credentials and self.state != self.FAILED:
+                return
+            self._credentials = credentials
+            self._retries = 0
+            generation = self._start_attempt()
+        self._notify()
+        Thread(
+            target=self._connect,
+            args=(generation, credentials, token_store),
+            daemon=True,
+            name="WyzeConnect",
+        ).start()
+
+    def _start_attempt(self) -> int:
+        # Called with the lock held
+        if self._retry_timer is not None:
+            self._retry_timer.cancel()
+            self._retry_timer = None
+        self._generation += 1
+        self.state = self.CONNECTING
+        self.error = None
+        return self._generation
+
+    def _retry(self, generation: int, token_store: Optional[TokenStore]):
+        with self._lock:
+            if generation != self._generation or self._credentials is None:
+                return
+            self._retry_timer = None
+            credentials = self._credentials
+            generation = self._start_attempt()
+        self._notify()
+        self._connect(generation, credentials, token_store)
+
+    def _connect(self, generation: int, credentials: Tuple, token_store: Optional[TokenStore]):
+        email, password, api_key, key_id = credentials
+        self._logger.info(f"Connecting to Wyze as {email}...")
+        try:
+            wyze = Wyze(
+                email=email,
+                password=password,
+                api_key=api_key,
+                key_id=key_id,
+                logger=self._logger,
+                token_store=token_store,
+                **self.options,
+            )
+        except Exception as e:
+            self._logger.exception(f"Failed to connect to Wyze as {email}.")
+            wyze = None
+            error = str(e)
+            retry = True
+        else:
+            if wyze.client is None:
+                # Retrying bad credentials would only get the account locked
+                error = "Login failed, check the credentials."
+                retry = False
+            elif not wyze.inventory_loaded:
+                error = "Could not load the Wyze device list."
+                retry = True
+            else:
+                error = None
+        with self._lock:
+            if generation != self._generation:
+                if wyze is not None:
+                    wyze.stop()
+                return
+            previous = self.wyze
+            if error is None:
+                self.wyze = wyze
+                self.state = self.CONNECTED
+                self._retries = 0
+            else:
+                if wyze is not None:
+                    wyze.stop()
+                self.state = self.FAILED
+                self.error = error
+                if retry:
+                    delay = min(self.max_retry_delay, self.retry_delay * 2 ** self._retries)
+                    self._retries += 1
+                    self.error = f"{error} Retrying in {delay:g} seconds."
+                    self._retry_timer = Timer(delay, self._retry, args=(generation, token_store))
+                    self._retry_timer.daemon = True
+                    self._retry_timer.start()
+        if error is None and previous is not None:
+            previous.stop()
+        self._notify()
+
+    def disconnect(self):
+        with self._lock:
+            if self._retry_timer is not None:
+                self._retry_timer.cancel()
+                self._retry_timer = None
+            self._generation += 1
+            self._credentials = None
+            wyze, self.wyze = self.wyze, None
+            self.state = self.DISCONNECTED
+            self.error = None
+        if wyze is not None:
+            wyze.stop()
+
+    def status(self) -> Dict:
+        return {
+            "state": self.state,
+            "email": self._credentials[0] if self._credentials is not None else None,
+            "error": self.error,
+        }
+
+    def _notify(self):
+        if self._on_change is None:
+            return
+        try:
+            self._on_change(self.status())
+        except Exception:
+            self._logger.exception("Failed to report the Wyze connection status.")
+
+
+class DeviceRefresher(Thread):
+    def __init__(self, wyze: Wyze):
+        super().__init__(daemon=True, name="WyzeDeviceRefresher")
+        self.wyze = wyze
+        self._stopped = False
+        self._wakeup = Event()
+
+    def run(self):
+        while True:
+            interval = self.wyze.active_interval if self.wyze.is_active() else self.wyze.ttl
+            woken = self._wakeup.wait(interval)
+            if self._stopped:
+                return
+            if woken:
+                # Activity changed, so start over with the new interval
+                self._wakeup.clear()
+                continue
+            self.wyze.refresh_devices()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+
+
+class DeviceHealth(Thread):
+    """
+    Per-device health from the cloud's is_online flag and the device's
+    circuit breaker. A slow probe refreshes the inventory while any device
+    is down and reports devices that changed health, so deferred commands
+    can be retried once their device is back. `on_probe` runs after every
+    probe, whether or not anything was down.
+    """
+
+    HEALTHY = "healthy"
+    OFFLINE = "offline"
+    UNREACHABLE = "unreachable"
+
+    def __init__(
+        self,
+        api: ApiClient,
+        probe_interval: float = 120,
+        refresh: Optional[Callable[[], None]] = None,
+        on_change: Optional[Callable[[Dict[str, str]], None]] = None,
+        on_probe: Optional[Callable[[], None]] = None,
+        logger=None,
+    ):
+        super().__init__(daemon=True, name="WyzeDeviceHealth")
+        self._logger = logger or logging.getLogger(__name__)
+        self.api = api
+        self.probe_interval = probe_interval
+        self._refresh = refresh
+        self._on_change = on_change
+        self._on_probe = on_probe
+        self._lock = Lock()
+        self._online: Dict[str, Optional[bool]] = {}
+        self._statuses: Dict[str, str] = {}
+        self.version = next(_versions)
+        self._wakeup = Event()
+
+    def status(self, device_mac: str) -> str:
+        if self._online.get(device_mac) is False:
+            return self.OFFLINE
+        if self.api.circuit_state(device_mac) == CircuitBreaker.OPEN:
+            return self.UNREACHABLE
+        return self.HEALTHY
+
+    def is_down(self, device_mac: str) -> bool:
+        return self.status(device_mac) != self.HEALTHY
+
+    def snapshot(self) -> Dict[str, str]:
+        with self._lock:
+            return dict(self._statuses)
+
+    def update_online(self, device_mac: str, is_online: Optional[bool]):
+        with self._lock:
+            if is_online is None:
+                self._online.pop(device_mac, None)
+            else:
+                self._online[device_mac] = is_online
+
+    def check(self):
+        with self._lock:
+            device_macs = self._online.keys() | self._statuses.keys()
+            statuses = {device_mac: self.status(device_mac) for device_mac in device_macs}
+            changes = {
+                device_mac: status
+                for device_mac, status in statuses.items()
+                if self._statuses.get(device_mac, self.HEALTHY) != status
+            }
+            self._statuses = statuses
+            if changes:
+                self.version = next(_versions)
+        if changes and self._on_change is not None:
+            try:
+                self._on_change(changes)
+            except Exception:
+                self._logger.exception("Failed to report Wyze device health changes.")
+
+    def run(self):
+        while not self._wakeup.wait(self.probe_interval):
+            # Only spend a cloud call when something is down
+            if self._refresh is not None and any(status != self.HEALTHY for status in self.snapshot().values()):
+                try:
+                    self._refresh()
+                except Exception:
+                    self._logger.exception("Failed to probe Wyze device health.")
+            self.check()
+            if self._on_probe is not None:
+                try:
+                    self._on_probe()
+                except Exception:
+                    self._logger.exception("Failed to run the Wyze device health probe callback.")
+
+    def stop(self):
+        self._wakeup.set()
+
+
+class Job:
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    COALESCED = "coalesced"
+    SUPPRESSED = "suppressed"
+    DEFERRED = "deferred"
+
+    _ids = itertools.count(1)
+
+    def __init__(self, device_mac: str, command: str, suppress: bool = False):
+        self.id = next(self._ids)
+        self.device_mac = device_mac
+        self.command = command
+        # Whether the job may be skipped when the device is already known to be in the target state
+        self.suppress = suppress
+        self.status = self.QUEUED
+        self.error = None
+        self.submitted_at = time.time()
+        self.queued_at = time.monotonic()
+        self.finished_at = None
+
+    def to_dict(self) -> Dict:
+        return {
+            "job_id": self.id,
+            "device_mac": self.device_mac,
+            "command": self.command,
+            "status": self.status,
+            "error": self.error,
+            "submitted_at": self.submitted_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class CommandDispatcher:
+    COMMANDS = {
+        "turn_on": True,
+        "turn_off": False,
+    }
+
+    def __init__(
+        self,
+        max_workers: int = 4,
+        history: int = 100,
+        coalesce_window: float = 0.5,
+        state_ttl: float = 60,
+        on_complete: Optional[Callable[[Job], None]] = None,
+        health: Optional[DeviceHealth] = None,
+        defer_offline: bool = True,
+        defer_timeout: float = 600,
+        resolve: Optional[Callable[[str], Optional[WyzeDevice]]] = None,
+        renew: Optional[Callable[[], None]] = None,
+        logger=None,
+    ):
+        self._logger = logger or logging.getLogger(__name__)
+        self._health = health
+        # Looks a device up in the current inventory, and renews an expired session
+        self._resolve = resolve
+        self._renew = renew
+        self.defer_offline = defer_offline
+        self.defer_timeout = defer_timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="WyzeCommand")
+        self._on_complete = on_complete
+        self._history = history
+        self.coalesce_window = coalesce_window
+        self.state_ttl = state_ttl
+        self._lock = Lock()
+        # One queue per device with work in flight. A device's queue is only
+        # drained by one worker at a time, so its commands run in order.
+        self._queues: Dict[str, Deque[Tuple[Job, WyzeDevice]]] = {}
+        self._jobs: OrderedDict[int, Job] = OrderedDict()
+        # Last known on/off state per device, with the monotonic time it was learned
+        self._states: Dict[str, Tuple[bool, float]] = {}
+        # Latest command per device that is down, run again when it recovers
+        self._deferred: Dict[str, Tuple[Job, WyzeDevice]] = {}
+        self.stats = {
+            "submitted": 0,
+            "executed": 0,
+            "failed": 0,
+            "coalesced": 0,
+            "suppressed": 0,
+            "deferred": 0,
+        }
+
+    def submit(self, device: WyzeDevice, command: str, suppress: bool = False) -> Job:
+        """
+        Queues a command for the device. With suppress, the command is skipped
+        when the device is already known to be in the target state, which
+        suits automatic actions but not a user asking for it explicitly.
+        """
+        if command not in self.COMMANDS:
+            raise ValueError(f"Unknown command {command}.")
+        job = Job(device.mac, command, suppress)
+        with self._lock:
+            self.stats["submitted"] += 1
+            self._jobs[job.id] = job
+            while len(self._jobs) > self._history:
+                self._jobs.popitem(last=False)
+        self._enqueue(job, device)
+        return job
+
+    def resume(self, device_mac: str):
+        with self._lock:
+            if (deferred := self._deferred.pop(device_mac, None)) is None:
+                return
+        job, device = deferred
+        if time.monotonic() - job.queued_at > self.defer_timeout:
+            self._expire(job, device)
+            return
+        self._logger.info(f"{device} is back, running deferred job {job.id}.")
+        job.status = Job.QUEUED
+        job.queued_at = time.monotonic()
+        self._enqueue(job, device)
+
+    def expire_deferred(self):
+        """Fails deferred jobs whose device has not come back within defer_timeout."""
+        now = time.monotonic()
+        with self._lock:
+            expired = [
+                (job, device) for job, device in self._deferred.values() if now - job.queued_at > self.defer_timeout
+            ]
+            for job, device in expired:
+                del self._deferred[device.mac]
+        for job, device in expired:
+            self._expire(job, device)
+
+    def _expire(self, job: Job, device: WyzeDevice):
+        job.error = f"{device} did not come back within {self.defer_timeout:g} seconds."
+        with self._lock:
+            self.stats["failed"] += 1
+        self._finish(job, Job.FAILED)
+
+    def _enqueue(self, job: Job, device: WyzeDevice):
+        with self._lock:
+            # Anything still waiting for this device is superseded by the new command
+            coalesced = [queued_job for queued_job, _ in self._queues.get(device.mac, ())]
+            if (deferred := self._deferred.pop(device.mac, None)) is not None:
+                coalesced.append(deferred[0])
+            self.stats["coalesced"] += len(coalesced)
+            if (queue := self._queues.get(device.mac)) is not None:
+                queue.clear()
+                queue.append((job, device))
+                start_worker = False
+            else:
+                self._queues[device.mac] = deque([(job, device)])
+                start_worker = True
+        for coalesced_job in coalesced:
+            self._finish(coalesced_job, Job.COALESCED)
+        if start_worker:
+            self._executor.submit(self._drain, device.mac)
+
+    def get_job(self, job_id: int) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return dict(self.stats)
+
+    def update_state(self, device_mac: str, is_on: bool):
+        with self._lock:
+            self._states[device_mac] = (is_on, time.monotonic())
+
+    def known_state(self, device_mac: str) -> Optional[bool]:
+        with self._lock:
+            if (state := self._states.get(device_mac)) is None:
+                return None
+            is_on, learned_at = state
+            if time.monotonic() - learned_at > self.state_ttl:
+                return None
+            return is_on
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    def _drain(self, device_mac: str):
+        while True:
+            with self._lock:
+                queue = self._queues[device_mac]
+                if not queue:
+                    del self._queues[device_mac]
+                    return
+                job, device = queue[0]
+                # Give later commands for this device a chance to supersede this one
+                wait = job.queued_at + self.coalesce_window - time.monotonic()
+                if wait <= 0:
+                    queue.popleft()
+            if wait > 0:
+                time.sleep(wait)
+                continue
+            self._run(job, device)
+
+    def _current(self, device: WyzeDevice) -> WyzeDevice:
+        # Jobs can wait for a long time, and the device they were made with
+        # may carry the token of a session that has since been renewed
+        if self._resolve is not None and (current := self._resolve(device.mac)) is not None:
+            return current
+        return device
+
+    def _execute(self, job: Job, device: WyzeDevice):
+        try:
+            getattr(device, job.command)()
+        except Exception as e:
+            if self._renew is None or not is_access_token_error(e):
+                raise
+            self._logger.info(f"Wyze access token expired, renewing it and retrying job {job.id}...")
+            self._renew()
+            getattr(self._current(device), job.command)()
+
+    def _run(self, job: Job, device: WyzeDevice):
+        device = self._current(device)
+        is_on = self.COMMANDS[job.command]
+        if job.suppress and self.known_state(device.mac) == is_on:
+            with self._lock:
+                self.stats["suppressed"] += 1
+            self._finish(job, Job.SUPPRESSED)
+            return
+        if self._health is not None and self._health.is_down(device.mac):
+            # Don't spend a cloud call (and its retries) on a device that is known to be down
+            self._hold(job, device, self._health.status(device.mac))
+            return
+        job.status = Job.RUNNING
+        try:
+            self._execute(job, device)
+        except Exception as e:
+            self._logger.exception(f"Failed to {job.command.replace('_', ' ')} {device}.")
+            job.error = str(e)
+            with self._lock:
+                self.stats["failed"] += 1
+                # The device may be in either state now
+                self._states.pop(device.mac, None)
+            self._finish(job, Job.FAILED)
+            return
+        with self._lock:
+            self.stats["executed"] += 1
+        self.update_state(device.mac, is_on)
+        self._finish(job, Job.DONE)
+
+    def _hold(self, job: Job, device: WyzeDevice, health: str):
+        if not self.defer_offline:
+            job.error = f"{device} is {health}."
+            with self._lock:
+                self.stats["failed"] += 1
+            self._finish(job, Job.FAILED)
+            return
+        self._logger.info(f"{device} is {health}, deferring job {job.id} until it comes back.")
+        with self._lock:
+            self.stats["deferred"] += 1
+            self._deferred[device.mac] = (job, device)
+            job.status = Job.DEFERRED
+        self._report(job)
+
+    def _finish(self, job: Job, status: str):
+        job.status = status
+        job.finished_at = time.time()
+        self._report(job)
+
+    def _report(self, job: Job):
+        if self._on_complete is not None:
+            try:
+                self._on_complete(job)
+            except Exception:
+                self._logger.exception(f"Failed to report the status of job {job.id}.")
+
+
 class WyzeDevice:
-    def __init__(self, device):
+    def __init__(self, device, api: ApiClient):
         self.device = device
+        self.api = api
         self.name = device.nickname
         self.type = device.type
         self.mac = device.mac
         self.model = device.product.model
 
+    @metrics.timed("wyze_turn_on")
     def turn_on(self):
-        self.client.turn_on(
+        self.api.call(
+            self.client.turn_on,
             device_mac=self.mac,
-            device_model=self.model
+            device_model=self.model,
+            circuit=self.mac,
         )
 
+    @metrics.timed("wyze_turn_off")
     def turn_off(self):
-        self.client.turn_off(
+        self.api.call(
+            self.client.turn_off,
             device_mac=self.mac,
-            device_model=self.model
+            device_model=self.model,
+            circuit=self.mac,
         )
 
     @property
@@ -74,26 +938,32 @@ class WyzeDevice:
             return "On"
         return "Off"
 
+    def state(self) -> Dict:
+        return {
+            "is_on": getattr(self.device, "is_on", None),
+            "is_online": getattr(self.device, "is_online", None),
+        }
+
     def __str__(self):
         return self.name
 
 
 class WyzeLight(WyzeDevice):
-    def __init__(self, client, device):
+    def __init__(self, client, device, api):
         self.client = client.bulbs
-        return super().__init__(device)
+        return super().__init__(device, api)
 
 
 class WyzePlug(WyzeDevice):
-    def __init__(self, client, device):
+    def __init__(self, client, device, api):
         self.client = client.plugs
-        return super().__init__(device)
+        return super().__init__(device, api)
 
 
 class WyzeCamera(WyzeDevice):
-    def __init__(self, client, device):
+    def __init__(self, client, device, api):
         self.client = client.cameras
-        return super().__init__(device)
+        return super().__init__(device, api)
 
 
 WYZE_DEVICE_TYPES = {
@@ -105,7 +975,7 @@ WYZE_DEVICE_TYPES = {
 }
 
 
-def WyzeDeviceFactory(client, device):
+def WyzeDeviceFactory(client, device, api: ApiClient):
     if device.type in WYZE_DEVICE_TYPES:
-        return WYZE_DEVICE_TYPES[device.type](client, device)
+        return WYZE_DEVICE_TYPES[device.type](client, device, api)
     return None
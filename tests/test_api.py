@@ -0,0 +1,169 @@
+"""ApiClient retries, backoff, circuit breaking and deadlines, against a fake clock."""
+import threading
+
+import pytest
+
+from octoprint_wyze import api
+from octoprint_wyze.api import ApiClient, CircuitBreaker, CircuitOpenError, DeadlineExceededError
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FlakyCall:
+    """Fails with `error` for the first `failures` calls, then returns "ok"."""
+
+    def __init__(self, failures, error=ConnectionError):
+        self.failures = failures
+        self.error = error
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.error("Simulated failure.")
+        return "ok"
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def client(clock):
+    return ApiClient(
+        rate=1000,
+        burst=1000,
+        timeout=30,
+        max_attempts=4,
+        base_delay=0.5,
+        max_delay=8,
+        failure_threshold=2,
+        reset_timeout=60,
+        clock=clock,
+        sleep=clock.sleep,
+    )
+
+
+def test_retries_retryable_errors_until_success(client, clock):
+    call = FlakyCall(failures=2)
+    assert client.call(call) == "ok"
+    assert call.calls == 3
+    assert len(clock.sleeps) == 2
+
+
+def test_gives_up_after_max_attempts(client, clock):
+    call = FlakyCall(failures=10)
+    with pytest.raises(ConnectionError):
+        client.call(call)
+    assert call.calls == 4
+    assert len(clock.sleeps) == 3
+
+
+def test_does_not_retry_other_errors(client, clock):
+    call = FlakyCall(failures=1, error=ValueError)
+    with pytest.raises(ValueError):
+        client.call(call)
+    assert call.calls == 1
+    assert clock.sleeps == []
+
+
+def test_backoff_stays_within_bounds(client, clock, monkeypatch):
+    # Always take the top of the jitter range
+    monkeypatch.setattr(api.random, "uniform", lambda low, high: high)
+    client.max_attempts = 7
+    with pytest.raises(ConnectionError):
+        client.call(FlakyCall(failures=10))
+    assert clock.sleeps == [0.5, 1, 2, 4, 8, 8]
+
+
+def test_backoff_never_passes_the_deadline(client, clock, monkeypatch):
+    monkeypatch.setattr(api.random, "uniform", lambda low, high: high)
+    client.timeout = 2
+    client.max_attempts = 10
+    call = FlakyCall(failures=10)
+    with pytest.raises(ConnectionError):
+        client.call(call)
+    assert sum(clock.sleeps) <= 2
+    assert call.calls == 3
+
+
+def test_breaker_opens_half_opens_and_reopens(client, clock):
+    failing = FlakyCall(failures=10, error=ValueError)
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            client.call(failing, circuit="plug")
+    assert client.circuit_state("plug") == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        client.call(failing, circuit="plug")
+    assert failing.calls == 2
+
+    clock.now += 60
+    assert client.circuit_state("plug") == CircuitBreaker.HALF_OPEN
+    # One failure while half-open is enough to open it again
+    with pytest.raises(ValueError):
+        client.call(failing, circuit="plug")
+    assert client.circuit_state("plug") == CircuitBreaker.OPEN
+
+    clock.now += 60
+    assert client.call(lambda: "ok", circuit="plug") == "ok"
+    assert client.circuit_state("plug") == CircuitBreaker.CLOSED
+
+
+def test_breakers_are_per_circuit(client):
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            client.call(FlakyCall(failures=1, error=ValueError), circuit="plug")
+    assert client.circuit_state("plug") == CircuitBreaker.OPEN
+    assert client.circuit_state("bulb") == CircuitBreaker.CLOSED
+    assert client.call(lambda: "ok", circuit="bulb") == "ok"
+
+
+def test_stalled_call_exceeds_deadline(client):
+    client.timeout = 0.05
+    release = threading.Event()
+    try:
+        with pytest.raises(DeadlineExceededError):
+            client.call(release.wait)
+    finally:
+        release.set()
+
+
+def test_stalled_calls_are_capped(client):
+    client.timeout = 0.01
+    client.max_abandoned = 2
+    release = threading.Event()
+    calls = []
+
+    def stall():
+        calls.append(1)
+        release.wait()
+
+    try:
+        for _ in range(3):
+            with pytest.raises(DeadlineExceededError):
+                client.call(stall)
+        # The third call failed fast without starting another thread
+        assert len(calls) == 2
+    finally:
+        release.set()
+
+
+def test_rate_limit_past_the_deadline(clock):
+    client = ApiClient(rate=0.1, burst=1, timeout=5, clock=clock, sleep=clock.sleep)
+    assert client.call(lambda: "ok") == "ok"
+    # The next token is 10 seconds away, past the 5 second deadline
+    with pytest.raises(DeadlineExceededError):
+        client.call(lambda: "ok")
+    assert clock.sleeps == []
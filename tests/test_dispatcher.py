@@ -0,0 +1,104 @@
+"""CommandDispatcher deferral of commands for devices that are down."""
+import threading
+
+import pytest
+
+from octoprint_wyze.wyze_devices import CommandDispatcher, DeviceHealth, Job
+
+
+class FakeHealth:
+    def __init__(self):
+        self.down = set()
+
+    def is_down(self, device_mac):
+        return device_mac in self.down
+
+    def status(self, device_mac):
+        return DeviceHealth.OFFLINE if device_mac in self.down else DeviceHealth.HEALTHY
+
+
+class FakeDevice:
+    def __init__(self, mac="AA:BB:CC:DD:EE:FF"):
+        self.mac = mac
+        self.commands = []
+
+    def turn_on(self):
+        self.commands.append("turn_on")
+
+    def turn_off(self):
+        self.commands.append("turn_off")
+
+    def __str__(self):
+        return self.mac
+
+
+class Reports(list):
+    """Collects (job id, status) pairs passed to on_complete, from any thread."""
+
+    def __init__(self):
+        super().__init__()
+        self._condition = threading.Condition()
+
+    def __call__(self, job):
+        with self._condition:
+            self.append((job.id, job.status))
+            self._condition.notify_all()
+
+    def wait(self, count):
+        with self._condition:
+            return self._condition.wait_for(lambda: len(self) >= count, 2)
+
+
+@pytest.fixture
+def reports():
+    return Reports()
+
+
+@pytest.fixture
+def health():
+    return FakeHealth()
+
+
+@pytest.fixture
+def dispatcher(reports, health):
+    dispatcher = CommandDispatcher(coalesce_window=0, on_complete=reports, health=health, defer_timeout=60)
+    yield dispatcher
+    dispatcher.shutdown()
+
+
+def test_deferred_job_is_reported(dispatcher, reports, health):
+    device = FakeDevice()
+    health.down.add(device.mac)
+    job = dispatcher.submit(device, "turn_on")
+    assert reports.wait(1)
+    assert reports == [(job.id, Job.DEFERRED)]
+    assert device.commands == []
+
+
+def test_deferred_job_runs_when_the_device_is_back(dispatcher, reports, health):
+    device = FakeDevice()
+    health.down.add(device.mac)
+    job = dispatcher.submit(device, "turn_on")
+    assert reports.wait(1)
+    health.down.clear()
+    dispatcher.resume(device.mac)
+    assert reports.wait(2)
+    assert reports == [(job.id, Job.DEFERRED), (job.id, Job.DONE)]
+    assert device.commands == ["turn_on"]
+
+
+def test_deferred_job_expires_while_the_device_stays_down(dispatcher, reports, health):
+    device = FakeDevice()
+    health.down.add(device.mac)
+    job = dispatcher.submit(device, "turn_on")
+    assert reports.wait(1)
+    dispatcher.expire_deferred()
+    assert job.status == Job.DEFERRED
+    job.queued_at -= 61
+    dispatcher.expire_deferred()
+    assert job.status == Job.FAILED and "did not come back" in job.error
+    assert reports == [(job.id, Job.DEFERRED), (job.id, Job.FAILED)]
+    # Nothing is left to run once the device does come back
+    health.down.clear()
+    dispatcher.resume(device.mac)
+    assert device.commands == []
@@ -0,0 +1,138 @@
+"""PendingActionRegistry and ActionScheduler: each action is cancelled or fired, never both."""
+import logging
+import threading
+import time
+
+import pytest
+
+from octoprint_wyze.events import Action, ActionScheduler, ActionType, EventType, PendingActionRegistry
+
+
+class FakeDevice:
+    def __init__(self, mac="AA:BB:CC:DD:EE:FF"):
+        self.mac = mac
+        self.commands = []
+
+    def turn_on(self):
+        self.commands.append("turn_on")
+
+    def turn_off(self):
+        self.commands.append("turn_off")
+
+    def __str__(self):
+        return self.mac
+
+
+def make_action(device=None, delay=0, event=EventType.PRINT_DONE, action=ActionType.TURN_OFF):
+    return Action(action, event, device or FakeDevice(), delay)
+
+
+@pytest.fixture
+def scheduler():
+    changes = []
+    scheduler = ActionScheduler(logging.getLogger(__name__), on_change=lambda change, action: changes.append((change, action.id)))
+    scheduler.changes = changes
+    scheduler.start()
+    yield scheduler
+    scheduler.stop()
+    scheduler.join(1)
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    return condition()
+
+
+def test_registry_indexes_by_key_and_device():
+    registry = PendingActionRegistry()
+    device = FakeDevice()
+    first = make_action(device)
+    second = make_action(device, action=ActionType.TURN_ON)
+    assert registry.add(first)
+    assert registry.add(second)
+    assert registry.find(device.mac, EventType.PRINT_DONE, ActionType.TURN_OFF) == [first]
+    assert set(registry.for_device(device.mac)) == {first, second}
+    assert len(registry) == 2
+
+
+def test_registry_if_idle_keeps_one_action_per_device():
+    registry = PendingActionRegistry()
+    device = FakeDevice()
+    assert registry.add(make_action(device), if_idle=True)
+    assert not registry.add(make_action(device), if_idle=True)
+    assert registry.add(make_action(FakeDevice("11:22:33:44:55:66")), if_idle=True)
+
+
+@pytest.mark.parametrize("first,second", [("cancel", "complete"), ("complete", "cancel")])
+def test_registry_only_first_transition_wins(first, second):
+    registry = PendingActionRegistry()
+    action = make_action()
+    registry.add(action)
+    assert getattr(registry, first)(action)
+    assert not getattr(registry, second)(action)
+    assert action.cancelled != action.fired
+    assert len(registry) == 0
+
+
+def test_registry_concurrent_cancel_and_complete():
+    registry = PendingActionRegistry()
+    for _ in range(200):
+        action = make_action()
+        registry.add(action)
+        results = []
+        barrier = threading.Barrier(2)
+
+        def race(transition):
+            barrier.wait()
+            results.append(transition(action))
+
+        threads = [threading.Thread(target=race, args=(transition,)) for transition in (registry.cancel, registry.complete)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sorted(results) == [False, True]
+        assert action.cancelled != action.fired
+    assert len(registry) == 0
+
+
+def test_scheduler_fires_due_action(scheduler):
+    device = FakeDevice()
+    action = make_action(device)
+    assert scheduler.schedule(action)
+    assert wait_for(lambda: device.commands == ["turn_off"])
+    assert scheduler.changes == [(ActionScheduler.ADDED, action.id), (ActionScheduler.FIRED, action.id)]
+    assert not scheduler.has_pending_actions()
+
+
+def test_scheduler_cancelled_action_never_fires(scheduler):
+    device = FakeDevice()
+    action = make_action(device, delay=0.1 / 60)
+    scheduler.schedule(action)
+    assert scheduler.cancel(action)
+    assert not scheduler.cancel(action)
+    time.sleep(0.2)
+    assert device.commands == []
+    assert scheduler.changes == [(ActionScheduler.ADDED, action.id), (ActionScheduler.CANCELLED, action.id)]
+
+
+def test_scheduler_cancel_racing_fire(scheduler):
+    devices = [FakeDevice(f"AA:BB:CC:DD:EE:{i:02X}") for i in range(100)]
+    actions = [make_action(device, delay=0.02 / 60) for device in devices]
+    for action in actions:
+        scheduler.schedule(action)
+    # Cancel around the moment they come due
+    time.sleep(0.015)
+    cancelled = {action.id for action in actions if scheduler.cancel(action)}
+    assert wait_for(lambda: not scheduler.has_pending_actions())
+    time.sleep(0.05)
+    for action, device in zip(actions, devices):
+        if action.id in cancelled:
+            assert device.commands == [] and not action.fired
+        else:
+            assert device.commands == ["turn_off"] and not action.cancelled
+    outcomes = [change for change, _ in scheduler.changes if change != ActionScheduler.ADDED]
+    assert len(outcomes) == len(actions)
+    assert outcomes.count(ActionScheduler.CANCELLED) == len(cancelled)
@@ -0,0 +1,122 @@
+"""TemperatureRule debounce and hysteresis, and TemperatureMonitor arming."""
+from octoprint_wyze.events import ActionType, EventHandler, EventType
+from octoprint_wyze.triggers import TemperatureMonitor, TemperatureRule
+
+
+def make_rule(direction=TemperatureRule.BELOW, threshold=50, hysteresis=2, debounce=5, after_event=None, id=1):
+    return TemperatureRule(
+        id=id,
+        device_mac="AA:BB:CC:DD:EE:FF",
+        tool="tool0",
+        direction=direction,
+        threshold=threshold,
+        action_type=ActionType.TURN_OFF,
+        hysteresis=hysteresis,
+        debounce=debounce,
+        after_event=after_event,
+    )
+
+
+def test_fires_once_debounce_has_passed():
+    rule = make_rule()
+    assert not rule.evaluate(49, 0)
+    assert not rule.evaluate(48, 4.9)
+    assert rule.evaluate(48, 5)
+    # Stays past the threshold, but has already fired
+    assert not rule.evaluate(40, 20)
+
+
+def test_debounce_restarts_when_the_temperature_bounces_back():
+    rule = make_rule()
+    assert not rule.evaluate(49, 0)
+    assert not rule.evaluate(50, 3)
+    assert not rule.evaluate(49, 4)
+    assert not rule.evaluate(49, 8.9)
+    assert rule.evaluate(49, 9)
+
+
+def test_rearms_only_past_the_hysteresis_band():
+    rule = make_rule()
+    rule.evaluate(49, 0)
+    assert rule.evaluate(49, 5)
+    # Inside the band: threshold + hysteresis is 52
+    rule.evaluate(51.9, 10)
+    rule.evaluate(49, 11)
+    assert not rule.evaluate(49, 20)
+    rule.evaluate(52, 30)
+    assert rule.armed
+    rule.evaluate(49, 31)
+    assert rule.evaluate(49, 36)
+
+
+def test_above_mirrors_below():
+    rule = make_rule(direction=TemperatureRule.ABOVE, threshold=200)
+    assert not rule.evaluate(200, 0)
+    rule.evaluate(201, 1)
+    assert rule.evaluate(201, 6)
+    rule.evaluate(198.5, 7)
+    assert not rule.armed
+    rule.evaluate(198, 8)
+    assert rule.armed
+
+
+def test_after_event_rules_wait_for_their_event():
+    fired = []
+    monitor = TemperatureMonitor(on_trigger=fired.append)
+    rule = make_rule(after_event=EventType.PRINT_DONE, debounce=0)
+    monitor.load([rule])
+    assert monitor.arm_events == {EventType.PRINT_DONE}
+    monitor.process({"tool0": (40, 0)})
+    assert fired == []
+    monitor.arm(EventType.PRINT_DONE)
+    monitor.process({"tool0": (40, 0)})
+    assert fired == [rule]
+    # Cooling past the band does not re-arm it, only the event does
+    monitor.process({"tool0": (60, 0)})
+    monitor.process({"tool0": (40, 0)})
+    assert fired == [rule]
+
+
+def test_reload_keeps_rule_state():
+    monitor = TemperatureMonitor(on_trigger=lambda rule: None)
+    rule = make_rule(debounce=0)
+    monitor.load([rule])
+    monitor.process({"tool0": (40, 0)})
+    assert not rule.armed
+    monitor.load([make_rule(debounce=0), make_rule(id=2, debounce=0)])
+    assert {id(loaded) for loaded in monitor.rules()} >= {id(rule)}
+    assert not next(loaded for loaded in monitor.rules() if loaded.id == 1).armed
+
+
+def test_reload_replaces_changed_rule_with_the_same_id():
+    monitor = TemperatureMonitor(on_trigger=lambda rule: None)
+    rule = make_rule(debounce=0)
+    monitor.load([rule])
+    monitor.process({"tool0": (40, 0)})
+    monitor.load([make_rule(threshold=30, debounce=0)])
+    loaded, = monitor.rules()
+    assert loaded is not rule
+    assert loaded.threshold == 30 and loaded.armed
+
+
+def test_import_then_reload_uses_the_imported_rules(tmp_path):
+    handler = EventHandler(str(tmp_path))
+    monitor = TemperatureMonitor(on_trigger=lambda rule: None)
+    handler.add_temperature_rule("AA:BB:CC:DD:EE:FF", "tool0", TemperatureRule.BELOW, 50, ActionType.TURN_OFF)
+    monitor.load(TemperatureRule(**row) for row in handler.get_temperature_rules())
+    exported = handler.export_rules()
+    exported["temperature_rules"][0].update(tool="bed", threshold=35)
+    handler.import_rules(exported)
+    monitor.load(TemperatureRule(**row) for row in handler.get_temperature_rules())
+    loaded, = monitor.rules()
+    assert (loaded.tool, loaded.threshold) == ("bed", 35)
+    handler.close()
+
+
+def test_monitor_ignores_missing_samples():
+    fired = []
+    monitor = TemperatureMonitor(on_trigger=fired.append)
+    monitor.load([make_rule(debounce=0)])
+    monitor.process({"bed": (20, 60)})
+    monitor.process({"tool0": (None, 0)})
+    assert fired == []